@@ -1,11 +1,15 @@
 # app.py
-import os, re, json, zipfile, time, logging
+import os, io, re, csv, json, zipfile, time, logging, hashlib, sqlite3, threading, multiprocessing, shutil, random, socket
+import contextvars
 from datetime import datetime
-from typing import List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from queue import Queue, Empty
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional
+from queue import Queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, request, Response, send_file, render_template_string, redirect, url_for
 
 # ---------- 可选解析器 ----------
@@ -30,14 +34,59 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(mess
 MODEL_API_KEY = os.getenv("MODEL_API_KEY", "")
 MODEL_BASE_URL = os.getenv("MODEL_BASE_URL", "").rstrip("/")
 MODEL_NAME     = os.getenv("MODEL_NAME", "deepseek-chat")
-CONCURRENCY    = int(os.getenv("CONCURRENCY", "2"))
+CONCURRENCY    = int(os.getenv("CONCURRENCY") or os.getenv("MAX_WORKERS") or "2")   # 初始并发窗口（MAX_WORKERS 为旧名）
+MAX_CONCURRENCY = max(CONCURRENCY, int(os.getenv("MAX_CONCURRENCY", "8")))           # 自适应并发上限
+PARSE_WORKERS  = int(os.getenv("PARSE_WORKERS", "2"))                                 # 解析级线程数
+PARSE_PROCS    = int(os.getenv("PARSE_PROCS", "2"))          # 解析子进程数，0 = 在当前进程内解析
+PARSE_TIMEOUT  = float(os.getenv("PARSE_TIMEOUT", "30"))     # 单文件解析超时（秒），超时即杀掉子进程
+PARSE_MAX_PAGES = int(os.getenv("PARSE_MAX_PAGES", "30"))    # PDF 最多解析页数
+MAX_MEMBER_MB  = int(os.getenv("MAX_MEMBER_MB", "50"))       # ZIP 内单个文件解压后上限，防 zip 炸弹
+SUPPORTED_EXT  = (".pdf",".html",".htm",".txt",".docx")
 MAX_UPLOAD_MB  = int(os.getenv("MAX_UPLOAD_MB", "200"))
+UPLOAD_CHUNK   = 1 << 20   # 上传按 1MB 分块落盘
+CACHE_TTL_DAYS    = float(os.getenv("CACHE_TTL_DAYS", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "20000"))   # 0 = 关闭缓存
+RESUME_TOKEN_BUDGET = int(os.getenv("RESUME_TOKEN_BUDGET", "3000"))   # 每份简历送入 LLM 的正文 token 上限
+BATCH_SIZE   = int(os.getenv("BATCH_SIZE", "1"))        # 每次请求最多打包几份简历；1 = 逐份调用
+BATCH_TOKENS = int(os.getenv("BATCH_TOKENS", "6000"))   # 打包时简历正文的 token 预算（本地估算）
+DEDUP_THRESHOLD   = float(os.getenv("DEDUP_THRESHOLD", "0.7"))   # 文本 MinHash 相似度 ≥ 阈值视为同一人（LLM 前合并）；0 = 关闭
+RUN_STORE      = os.getenv("RUN_STORE", "sqlite")   # 任务状态存储：sqlite（多 worker/多实例共享 DATA_DIR）| memory（单进程）
+STREAM_POLL_S  = float(os.getenv("STREAM_POLL_S", "0.5"))   # SSE 拉取事件日志的间隔；间隔内的多条消息合并成一次写出
+RUN_STALE_S    = float(os.getenv("RUN_STALE_S", "120"))   # 执行中任务的心跳超过此秒数未更新，视为进程已退出，可被续跑接管
+UPLOAD_RETENTION_H   = float(os.getenv("UPLOAD_RETENTION_HOURS", "24"))   # 已完成任务的上传原件保留时长（未完成的保留以便续跑）
+ARTIFACT_RETENTION_D = float(os.getenv("ARTIFACT_RETENTION_DAYS", "7"))   # 任务产物（Excel/结果日志/事件/榜单）保留天数
+MAX_MEM_RUNS   = int(os.getenv("MAX_MEM_RUNS", "50"))         # memory 后端最多在内存里保留的已结束任务（LRU）
+GC_INTERVAL_S  = float(os.getenv("GC_INTERVAL_S", "600"))     # 后台清理间隔
+PARTIAL_TOP_K  = int(os.getenv("PARTIAL_TOP_K", "50"))       # 运行中“下载当前结果”默认导出前 K 名
+JSON_MODE      = os.getenv("JSON_MODE", "auto").lower()       # response_format=json_object：auto（服务端不支持时自动关闭）/ on / off
+LLM_TIMEOUT    = float(os.getenv("LLM_TIMEOUT", "60"))        # 单次请求超时（秒），同时受任务截止时间约束
+LLM_RETRIES    = int(os.getenv("LLM_RETRIES", "2"))           # 5xx/429/超时/断连 的重试次数（抖动指数退避，尊重 Retry-After）
+RETRY_BASE_S   = float(os.getenv("RETRY_BASE_S", "1"))
+RUN_DEADLINE_MIN = float(os.getenv("RUN_DEADLINE_MIN", "0"))  # 单个任务的 LLM 截止时间（分钟），到点后剩余的记为失败、可续跑；0 不限
+HEDGE          = os.getenv("HEDGE", "0") == "1"               # 请求超过近期 p95 仍未返回时补发一份，先到先用
+LLM_RPM        = float(os.getenv("LLM_RPM", "0"))            # 本进程每分钟最多发出的请求数（所有任务共享），0 不限
+BREAKER_FAILS  = int(os.getenv("BREAKER_FAILS", "5"))         # 连续多少次服务端故障后熔断
+BREAKER_COOLDOWN_S = float(os.getenv("BREAKER_COOLDOWN_S", "30"))
+CASCADE        = os.getenv("CASCADE", "0") == "1"            # 两档打分：快速档先出分，临界/高分的再交完整档
+FAST_BASE_URL  = (os.getenv("FAST_BASE_URL") or MODEL_BASE_URL).rstrip("/")
+FAST_API_KEY   = os.getenv("FAST_API_KEY") or MODEL_API_KEY
+FAST_MODEL_NAME = os.getenv("FAST_MODEL_NAME") or MODEL_NAME   # 不另配模型时即同一模型 + 短提示
+FAST_CONCURRENCY = int(os.getenv("FAST_CONCURRENCY") or CONCURRENCY)
+FAST_MAX_CONCURRENCY = max(FAST_CONCURRENCY, int(os.getenv("FAST_MAX_CONCURRENCY") or MAX_CONCURRENCY))
+FAST_RPM       = float(os.getenv("FAST_RPM", "0"))           # 快速档的每分钟请求上限
+FAST_TOKEN_BUDGET = int(os.getenv("FAST_TOKEN_BUDGET", "1500"))   # 快速档每份简历的正文 token 上限
+ESCALATE_MIN    = float(os.getenv("ESCALATE_MIN", "75"))       # 快速档分数 ≥ 此值升级完整档
+ESCALATE_MARGIN = float(os.getenv("ESCALATE_MARGIN", "5"))     # 距分档线（90/80/70）不超过此值的也升级
+SPLIT_PROFILE  = os.getenv("SPLIT_PROFILE", "1") == "1"       # 档案抽取（与岗位无关，按简历缓存）与岗位打分分两步
+PROMPT_VERSION = "v1"   # 修改 PROMPT_SYS / PROMPT_SCORE / build_messages 时递增，旧缓存自动失效
+PROFILE_VERSION = "pf1" # 修改 PROMPT_PROFILE 时递增，旧档案缓存自动失效
 
 DATA_DIR = os.path.abspath("./data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
 app = Flask(__name__)
-RUNS: Dict[str, Dict[str, Any]] = {}
+app.config["MAX_CONTENT_LENGTH"] = (MAX_UPLOAD_MB + 1) * 1024 * 1024   # 超限请求在解析表单前直接 413
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
 
 # ---------- HTML ----------
 INDEX_HTML = """
@@ -74,37 +123,62 @@ ul.files li button{background:#334155;color:#cbd5e1;border:0;border-radius:8px;p
   <h1>linkedin-批量简历分析</h1>
   <div class="card"><p class="note">说明：上传你合规导出的 ZIP/PDF/HTML/TXT/DOCX，后端并发解析与AI打分，实时输出并最终产出Excel/榜单。</p></div>
 
-  <form id="f" action="/process" method="post" enctype="multipart/form-data">
+  {% if src %}<div class="card"><p class="note">用新的岗位条件重新评分任务 {{src}}：复用其上传文件，档案抽取结果已缓存，只需重新打分。</p></div>{% endif %}
+  <form id="f" action="{{ '/rescore/' ~ src if src else '/process' }}" method="post" enctype="multipart/form-data">
     <div class="card">
       <div class="row">
         <div>
           <label>职位名称（必填）</label>
-          <input name="role" placeholder="如：资深基础设施架构师" required>
+          <input name="role" value="{{job.role}}" placeholder="如：资深基础设施架构师" required>
         </div>
         <div>
           <label>方向（选填）</label>
-          <input name="track" placeholder="如：Infra / SRE / 医疗IT">
+          <input name="track" value="{{job.track}}" placeholder="如：Infra / SRE / 医疗IT">
         </div>
       </div>
 
       <div class="row">
         <div>
           <label>Must-have 关键词（逗号分隔）</label>
-          <input name="must" placeholder="如：K8s, DevOps, 合规"/>
+          <input name="must" value="{{job.must}}" placeholder="如：K8s, DevOps, 合规"/>
         </div>
         <div>
           <label>Nice-to-have 关键词（逗号分隔）</label>
-          <input name="nice" placeholder="如：HPC, 金融, 医药"/>
+          <input name="nice" value="{{job.nice}}" placeholder="如：HPC, 金融, 医药"/>
         </div>
       </div>
 
       <label>限制说明（地域/签证/语言等）</label>
-      <input name="limits" placeholder="如：上海/苏州；英文流利；可出差"/>
+      <input name="limits" value="{{job.limits}}" placeholder="如：上海/苏州；英文流利；可出差"/>
 
       <label style="margin-top:10px">补充说明（可粘贴JD要点）</label>
-      <textarea name="note" placeholder="可写关键点、筛选口径、其他背景要求等"></textarea>
+      <textarea name="note" placeholder="可写关键点、筛选口径、其他背景要求等">{{job.note}}</textarea>
+
+      <label>优先级（多个任务同时运行时按 4 : 1 : 0.25 分配 AI 并发）</label>
+      <select name="priority" style="border:1px solid var(--border);border-radius:10px;background:#0b1018;color:#e5e7eb;padding:10px">
+        {% for v, t in [("normal","普通"),("high","加急（小批量优先出结果）"),("low","低（后台大批量）")] %}
+        <option value="{{v}}" {{ 'selected' if priority == v else '' }}>{{t}}</option>
+        {% endfor %}
+      </select>
+
+      <div class="row">
+        <div>
+          <label>只送本地关键词分前 N 名给 AI（选填，空=全部）</label>
+          <input name="llm_top_n" value="{{top_n or ''}}" placeholder="如：60"/>
+        </div>
+        <div>
+          <label>本地关键词分低于此值不送 AI（选填；每个关键词都出现一次约 45 分，各 3 次约 71 分，100 分达不到）</label>
+          <input name="llm_min_local" value="{{min_local or ''}}" placeholder="如：20"/>
+        </div>
+      </div>
+      <small class="note">未送 AI 的候选人仍会出现在 Excel 中，等级为“未评估”，附本地分。</small>
     </div>
 
+    {% if src %}
+    <div class="card">
+      <label><input type="checkbox" name="local_only" value="1"> 仅本地关键词打分（不调用 AI；已抽取过档案的候选人附带档案信息）</label>
+    </div>
+    {% else %}
     <div class="card">
       <h3 style="margin:0 0 8px">上传候选集（支持多文件，ZIP/PDF/HTML/TXT/DOCX）</h3>
       <div class="filebox">
@@ -113,9 +187,10 @@ ul.files li button{background:#334155;color:#cbd5e1;border:0;border-radius:8px;p
         <small class="note">可把 Recruiter Lite 每页导出的 ZIP 一次选中多个；如体量很大建议分批。</small>
       </div>
     </div>
+    {% endif %}
 
     <div class="card">
-      <button class="btn" type="submit">开始分析（生成Excel清单）</button>
+      <button class="btn" type="submit">{{ '重新评分' if src else '开始分析（生成Excel清单）' }}</button>
     </div>
   </form>
 </div>
@@ -123,7 +198,7 @@ ul.files li button{background:#334155;color:#cbd5e1;border:0;border-radius:8px;p
 <script>
 const file = document.getElementById('file');
 const flist = document.getElementById('flist');
-file.addEventListener('change', refreshList);
+if(file) file.addEventListener('change', refreshList);
 function refreshList(){
   flist.innerHTML='';
   const dt = new DataTransfer();
@@ -164,6 +239,8 @@ a.btn{display:inline-block;text-decoration:none}
 <body><div class="wrap">
   <div class="row">
     <a class="btn" href="/resume/{{rid}}">继续（断点续跑）</a>
+    <a class="btn" href="/rescore/{{rid}}" style="background:#7c3aed">用新条件重新评分</a>
+    <button class="btn" id="cancel" style="background:#b91c1c">取消</button>
     <a class="btn" href="/" style="background:#334155">返回</a>
   </div>
   <h1>任务 {{name}} · 实时报告</h1>
@@ -171,19 +248,28 @@ a.btn{display:inline-block;text-decoration:none}
 
   <div class="row">
     <a id="dl" class="btn" href="/download/{{rid}}" style="pointer-events:none;opacity:.5">下载 Excel</a>
+    <a id="dlcsv" class="btn" href="/download/{{rid}}?fmt=csv" style="pointer-events:none;opacity:.5;background:#334155">CSV</a>
+    <a class="btn" href="/partial/{{rid}}" style="background:#0f766e">下载当前结果（前 {{top_k}}）</a>
     <a class="btn" id="rank" href="/report/{{rid}}" target="_blank" style="background:#16a34a">查看榜单</a>
   </div>
 </div>
 <script>
 const log = document.getElementById('log');
-const dl  = document.getElementById('dl');
+const dls = [document.getElementById('dl'), document.getElementById('dlcsv')];
 const es  = new EventSource("/stream/{{rid}}");
+document.getElementById('cancel').onclick = ()=>{
+  fetch("/cancel/{{rid}}", {method:"POST"}).then(r=>{ if(!r.ok) r.text().then(append); });
+};
+function append(t){ log.appendChild(document.createTextNode("\\n"+t)); log.scrollTop = log.scrollHeight; }
 es.onmessage = (ev)=>{
-  if(ev.data==="__READY_EXCEL__"){ dl.style.pointerEvents='auto'; dl.style.opacity='1'; return; }
-  log.appendChild(document.createTextNode("\\n"+ev.data));
-  log.scrollTop = log.scrollHeight;
+  if(ev.data==="__READY_EXCEL__"){ dls.forEach(a=>{ a.style.pointerEvents='auto'; a.style.opacity='1'; }); return; }
+  append(ev.data);
 };
-es.onerror = (e)=>{ es.close(); };
+// 任务结束时服务端发 end 事件并关闭连接；断线时浏览器会带 Last-Event-ID 自动重连，不丢不重
+es.addEventListener('end', (ev)=>{
+  es.close();
+  if(ev.data==="stalled") append("⚠ 执行该任务的进程已中断，可点击“继续（断点续跑）”");
+});
 </script>
 </body></html>
 """
@@ -205,7 +291,7 @@ th,td{border-bottom:1px solid var(--border);padding:8px 6px;text-align:left;vert
   <h1>榜单 · {{name}}</h1>
   <table>
     <thead><tr>
-      <th>排名</th><th>候选人</th><th>公司/职位</th><th>等级</th><th>分数</th><th>Email</th><th>摘要</th>
+      <th>排名</th><th>候选人</th><th>公司/职位</th><th>等级</th><th>分数</th><th>本地分</th><th>Email</th><th>摘要</th>
     </tr></thead>
     <tbody>
     {% for row in rows %}
@@ -215,6 +301,7 @@ th,td{border-bottom:1px solid var(--border);padding:8px 6px;text-align:left;vert
         <td>{{row.get('current_company','')}} / {{row.get('current_title','')}}</td>
         <td><span class="badge">{{row.get('grade','')}}</span></td>
         <td>{{row.get('score','')}}</td>
+        <td>{{row.get('local_score','')}}</td>
         <td>{{row.get('email','')}}</td>
         <td>{{row.get('remark','')}}</td>
       </tr>
@@ -230,32 +317,240 @@ def slugify(text: str) -> str:
     s = re.sub(r"[-\s]+", "_", s)
     return s or "job"
 
-def ensure_run(rid:str) -> Dict[str,Any]:
-    run = RUNS.get(rid)
-    if not run:
-        RUNS[rid] = run = {"q":Queue(), "dir":os.path.join(DATA_DIR,rid), "done":False,
-                           "summary":[], "ts":time.time(), "role":"", "track":"", "name":rid}
-        os.makedirs(run["dir"], exist_ok=True)
-    return run
+def safe_filename(name:str, taken:set) -> str:
+    """去掉目录部分与控制/保留字符（保留中文），同名（不区分大小写）自动加序号"""
+    name = os.path.basename((name or "").replace("\\", "/")).strip()
+    name = re.sub(r'[\x00-\x1f<>:"|?*]+', "_", name).lstrip(".") or "upload"
+    base, ext = os.path.splitext(name)
+    base, ext = base[:100], ext[:10]
+    cand, k = base + ext, 1
+    while cand.lower() in taken:
+        k += 1
+        cand = f"{base}_{k}{ext}"
+    taken.add(cand.lower())
+    return cand
+
+def save_upload(f, path:str, budget:int):
+    """分块写盘并顺带算 sha256；累计超过 budget 字节立即中止。返回 (字节数, sha256)，超限返回 (-1, "")"""
+    h, n = hashlib.sha256(), 0
+    with open(path, "wb") as o:
+        while True:
+            chunk = f.stream.read(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            n += len(chunk)
+            if n > budget:
+                break
+            h.update(chunk)
+            o.write(chunk)
+    if n > budget:
+        os.remove(path)
+        return -1, ""
+    return n, h.hexdigest()
+
+RID_RE = re.compile(r"^[\w-]{1,120}$")
+
+def run_dir(rid:str) -> str:
+    return os.path.join(DATA_DIR, rid)
+
+# ---------- 任务状态存储 ----------
+END_STATUSES = ("done", "partial", "failed", "cancelled")   # 任务已结束（不再有进程在执行）；partial = 有失败的文件，可续跑重试
+
+class MemoryRunStore:
+    """任务状态（元信息/进度/结果/事件日志）的进程内实现：只适合单 worker。
+    状态 status：running / done / failed；owner + heartbeat 标识正在执行它的进程"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs: Dict[str,Dict[str,Any]] = {}
+        self.evs: Dict[str,List[tuple]] = {}
+        self.rows: Dict[str,List[Dict[str,Any]]] = {}
+
+    def create(self, rid:str, info:Dict[str,Any]):
+        with self.lock:
+            self.runs[rid] = {"rid":rid, "status":"new", "owner":"", "heartbeat":0.0, **info}
+            self.evs[rid], self.rows[rid] = [], []
+
+    def get(self, rid:str) -> Optional[Dict[str,Any]]:
+        with self.lock:
+            run = self.runs.get(rid)
+            if not run:
+                return None
+            run["_access"] = time.time()
+            return dict(run)
+
+    def list_runs(self) -> List[Dict[str,Any]]:
+        with self.lock:
+            return [dict(r) for r in self.runs.values()]
+
+    def evict_lru(self, keep:int) -> int:
+        """只保留最近访问的 keep 个已结束任务；被淘汰的任务磁盘上的结果日志仍在，可经 /resume 重建"""
+        with self.lock:
+            ended = sorted((r for r in self.runs.values() if r["status"] in END_STATUSES),
+                           key=lambda r: r.get("_access", r["heartbeat"]))
+            victims = [r["rid"] for r in ended[:max(0, len(ended) - keep)]]
+            for rid in victims:
+                self.runs.pop(rid, None); self.evs.pop(rid, None); self.rows.pop(rid, None)
+            return len(victims)
+
+    def update(self, rid:str, **info):
+        with self.lock:
+            if rid in self.runs:
+                self.runs[rid].update(info)
+
+    def claim(self, rid:str, owner:str, stale_s:float) -> bool:
+        """原子地把任务标记为由 owner 执行；已有进程在执行且心跳新鲜时返回 False"""
+        now = time.time()
+        with self.lock:
+            run = self.runs.get(rid)
+            if not run or (run["status"] == "running" and now - run["heartbeat"] < stale_s):
+                return False
+            run.update(status="running", owner=owner, heartbeat=now)
+            return True
+
+    def heartbeat(self, rid:str):
+        self.update(rid, heartbeat=time.time())
+
+    def append_event(self, rid:str, msg:str) -> int:
+        with self.lock:
+            evs = self.evs.setdefault(rid, [])
+            evs.append((len(evs) + 1, msg))
+            return len(evs)
+
+    def events(self, rid:str, after:int=0, limit:int=500) -> List[tuple]:
+        with self.lock:
+            return self.evs.get(rid, [])[after:after + limit]
+
+    def set_results(self, rid:str, rows:List[Dict[str,Any]]):
+        with self.lock:
+            self.rows[rid] = list(rows)
+
+    def results(self, rid:str) -> List[Dict[str,Any]]:
+        with self.lock:
+            return list(self.rows.get(rid, []))
+
+    def delete(self, rid:str):
+        with self.lock:
+            self.runs.pop(rid, None); self.evs.pop(rid, None); self.rows.pop(rid, None)
+
+class SqliteRunStore:
+    """同一接口的 SQLite 实现（DATA_DIR/runs.sqlite3）：同机多个 gunicorn worker、或挂同一磁盘的多实例都能服务任一任务"""
+    def __init__(self, path:str):
+        self.path = path
+        self.local = threading.local()
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (rid TEXT PRIMARY KEY, status TEXT NOT NULL, owner TEXT NOT NULL,
+                                             heartbeat REAL NOT NULL, info TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS events (rid TEXT NOT NULL, seq INTEGER NOT NULL, msg TEXT NOT NULL,
+                                               PRIMARY KEY (rid, seq));
+            CREATE TABLE IF NOT EXISTS results (rid TEXT PRIMARY KEY, rows TEXT NOT NULL);
+        """)
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:   # 每线程一个连接，写冲突由 SQLite 锁 + busy timeout 处理
+            db = self.local.db = sqlite3.connect(self.path, timeout=15, isolation_level=None)
+        return db
+
+    def create(self, rid:str, info:Dict[str,Any]):
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?)", (rid, "new", "", 0.0, json.dumps(info, ensure_ascii=False)))
+        db.execute("DELETE FROM events WHERE rid=?", (rid,))
+        db.execute("DELETE FROM results WHERE rid=?", (rid,))
+
+    def get(self, rid:str) -> Optional[Dict[str,Any]]:
+        row = self._db().execute("SELECT status, owner, heartbeat, info FROM runs WHERE rid=?", (rid,)).fetchone()
+        if not row:
+            return None
+        return {"rid":rid, "status":row[0], "owner":row[1], "heartbeat":row[2], **json.loads(row[3])}
+
+    def list_runs(self) -> List[Dict[str,Any]]:
+        return [{"rid":r[0], "status":r[1], "owner":r[2], "heartbeat":r[3], **json.loads(r[4])}
+                for r in self._db().execute("SELECT rid, status, owner, heartbeat, info FROM runs")]
+
+    def evict_lru(self, keep:int) -> int:
+        return 0   # 状态都在磁盘上，不占进程内存
+
+    def update(self, rid:str, **info):
+        cols = {k: info.pop(k) for k in ("status", "owner", "heartbeat") if k in info}
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT info FROM runs WHERE rid=?", (rid,)).fetchone()
+            if row:
+                merged = {**json.loads(row[0]), **info}
+                db.execute("UPDATE runs SET info=? WHERE rid=?", (json.dumps(merged, ensure_ascii=False), rid))
+                for k, v in cols.items():
+                    db.execute(f"UPDATE runs SET {k}=? WHERE rid=?", (v, rid))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def claim(self, rid:str, owner:str, stale_s:float) -> bool:
+        now = time.time()
+        cur = self._db().execute(
+            "UPDATE runs SET status='running', owner=?, heartbeat=? WHERE rid=? AND (status!='running' OR heartbeat<?)",
+            (owner, now, rid, now - stale_s))
+        return cur.rowcount == 1
+
+    def heartbeat(self, rid:str):
+        self._db().execute("UPDATE runs SET heartbeat=? WHERE rid=?", (time.time(), rid))
+
+    def append_event(self, rid:str, msg:str) -> int:
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            seq = db.execute("SELECT COALESCE(MAX(seq),0)+1 FROM events WHERE rid=?", (rid,)).fetchone()[0]
+            db.execute("INSERT INTO events VALUES (?,?,?)", (rid, seq, msg))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return seq
+
+    def events(self, rid:str, after:int=0, limit:int=500) -> List[tuple]:
+        return self._db().execute("SELECT seq, msg FROM events WHERE rid=? AND seq>? ORDER BY seq LIMIT ?",
+                                  (rid, after, limit)).fetchall()
+
+    def set_results(self, rid:str, rows:List[Dict[str,Any]]):
+        self._db().execute("INSERT OR REPLACE INTO results VALUES (?,?)",
+                           (rid, json.dumps(rows, ensure_ascii=False, default=list)))
+
+    def results(self, rid:str) -> List[Dict[str,Any]]:
+        row = self._db().execute("SELECT rows FROM results WHERE rid=?", (rid,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def delete(self, rid:str):
+        db = self._db()
+        for t in ("runs", "events", "results"):
+            db.execute(f"DELETE FROM {t} WHERE rid=?", (rid,))
+
+STORE = SqliteRunStore(os.path.join(DATA_DIR, "runs.sqlite3")) if RUN_STORE == "sqlite" else MemoryRunStore()
+
+def get_run(rid:str) -> Optional[Dict[str,Any]]:
+    """未知 rid 返回 None（不再顺手创建空任务）"""
+    return STORE.get(rid) if RID_RE.match(rid or "") else None
 
 def put(rid: str, msg: str):
-    RUNS.get(rid, {}).get("q", Queue()).put(msg)
+    STORE.append_event(rid, msg)
 
-def text_from_file(path:str) -> str:
-    ext = os.path.splitext(path)[1].lower()
+def text_from_bytes(raw:bytes, ext:str, name:str="") -> str:
+    ext = ext.lower()
     try:
         if ext == ".pdf" and pdf_extract_text:
-            return pdf_extract_text(path) or ""
+            return pdf_extract_text(io.BytesIO(raw), maxpages=PARSE_MAX_PAGES) or ""
         if ext == ".docx" and docx:
-            return "\n".join(p.text for p in docx.Document(path).paragraphs)
+            return "\n".join(p.text for p in docx.Document(io.BytesIO(raw)).paragraphs)
         if ext in (".html",".htm") and BeautifulSoup:
-            with open(path,"rb") as f:
-                soup = BeautifulSoup(f, "html.parser")
-                return soup.get_text(" ", strip=True)
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()
+            soup = BeautifulSoup(raw, "html.parser")
+            for t in soup(["script", "style", "noscript"]):
+                t.decompose()
+            return soup.get_text("\n", strip=True)   # 保留行结构，便于识别分节
+        return raw.decode("utf-8", errors="ignore")
     except Exception as e:
-        logging.warning("parse error %s: %s", path, e)
+        logging.warning("parse error %s: %s", name, e)
         return ""
 
 EMAIL_RE = re.compile(r"[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,}", re.I)
@@ -281,21 +576,472 @@ def estimate_age_from_edu(education: Any) -> str:
         pass
     return "不详"
 
-def llm_chat(messages: List[Dict[str,str]], temperature: float=0.2, max_tokens:int=1024) -> str:
-    if not MODEL_API_KEY or not MODEL_BASE_URL:
-        return ""
-    url = f"{MODEL_BASE_URL}/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {MODEL_API_KEY}", "Content-Type": "application/json"}
-    payload = {"model": MODEL_NAME, "messages": messages, "temperature": temperature,
-               "max_tokens": max_tokens, "stream": False}
+# ---------- 指标 ----------
+class Metrics:
+    """计数器 + 直方图（另留一份抽样用于算分位数）。全局一份供 /metrics 导出，每个任务再记一份用于性能汇总"""
+    BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    SAMPLES = 2048
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[tuple,float] = {}
+        self.hists: Dict[tuple,Dict[str,Any]] = {}
+
+    def inc(self, name:str, v:float=1, **labels):
+        k = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0) + v
+
+    def observe(self, name:str, v:float, **labels):
+        k = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.hists.get(k)
+            if h is None:
+                h = self.hists[k] = {"buckets":[0]*len(self.BUCKETS), "sum":0.0, "count":0, "samples":[]}
+            for i, b in enumerate(self.BUCKETS):
+                if v <= b:
+                    h["buckets"][i] += 1
+            h["sum"] += v
+            h["count"] += 1
+            if len(h["samples"]) < self.SAMPLES:
+                h["samples"].append(v)
+            else:   # 蓄水池抽样
+                j = random.randrange(h["count"])
+                if j < self.SAMPLES:
+                    h["samples"][j] = v
+
+    def total(self, name:str, **labels) -> float:
+        """同名计数器中标签包含 labels 的求和"""
+        want = set(labels.items())
+        with self.lock:
+            return sum(v for (n, lb), v in self.counters.items() if n == name and want <= set(lb))
+
+    def by_label(self, name:str, label:str) -> Dict[str,float]:
+        out: Dict[str,float] = {}
+        with self.lock:
+            for (n, lb), v in self.counters.items():
+                if n == name:
+                    key = dict(lb).get(label, "")
+                    out[key] = out.get(key, 0) + v
+        return out
+
+    def hist(self, name:str, **labels) -> Dict[str,Any]:
+        """合并同名直方图：{count, sum, p50, p95, max}"""
+        want = set(labels.items())
+        with self.lock:
+            hs = [h for (n, lb), h in self.hists.items() if n == name and want <= set(lb)]
+            samples = sorted(v for h in hs for v in h["samples"])
+            count, total = sum(h["count"] for h in hs), sum(h["sum"] for h in hs)
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+        return {"count":count, "sum":total, "p50":pick(0.5), "p95":pick(0.95), "max":samples[-1] if samples else 0.0}
+
+    def hist_labels(self, name:str, label:str) -> List[str]:
+        with self.lock:
+            return list(dict.fromkeys(dict(lb).get(label, "") for (n, lb) in self.hists if n == name))   # 按首次出现顺序
+
+    def prometheus(self, prefix:str="resume_") -> str:
+        def fmt(lb, *extra):
+            kv = [f'{k}="{v}"' for k, v in lb] + list(extra)
+            return "{" + ",".join(kv) + "}" if kv else ""
+        lines, typed = [], set()
+        with self.lock:
+            for (n, lb), v in sorted(self.counters.items()):
+                if n not in typed:
+                    typed.add(n); lines.append(f"# TYPE {prefix}{n} counter")
+                lines.append(f"{prefix}{n}{fmt(lb)} {v:g}")
+            for (n, lb), h in sorted(self.hists.items()):
+                if n not in typed:
+                    typed.add(n); lines.append(f"# TYPE {prefix}{n} histogram")
+                for b, c in zip(self.BUCKETS + ("+Inf",), h["buckets"] + [h["count"]]):
+                    le = 'le="%s"' % (b if isinstance(b, str) else f"{b:g}")
+                    lines.append(f"{prefix}{n}_bucket{fmt(lb, le)} {c}")
+                lines.append(f"{prefix}{n}_sum{fmt(lb)} {h['sum']:.6f}")
+                lines.append(f"{prefix}{n}_count{fmt(lb)} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+RUN_METRICS: contextvars.ContextVar = contextvars.ContextVar("run_metrics", default=None)   # 当前任务的指标，流水线线程继承
+
+def inc(name:str, v:float=1, **labels):
+    METRICS.inc(name, v, **labels)
+    m = RUN_METRICS.get()
+    if m:
+        m.inc(name, v, **labels)
+
+def observe(name:str, v:float, **labels):
+    METRICS.observe(name, v, **labels)
+    m = RUN_METRICS.get()
+    if m:
+        m.observe(name, v, **labels)
+
+# ---------- LLM 调用 ----------
+RUN_DEADLINE: contextvars.ContextVar = contextvars.ContextVar("run_deadline", default=0.0)
+RUN_ID: contextvars.ContextVar = contextvars.ContextVar("run_id", default="")
+PRIORITY_WEIGHTS = {"high":4.0, "normal":1.0, "low":0.25}   # 多个任务同时排队时各自分到的窗口份额之比
+
+class RunScheduler:
+    """本进程内执行中任务的优先级与取消标记。各档并发窗口按这里的权重在任务间分配；取消后排队中的请求立即退出"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.weights: Dict[str,float] = {}
+        self.cancelled_ids: set = set()
+        self.limiters: List["AdaptiveLimiter"] = []
+        self.breakers: List["CircuitBreaker"] = []
+
+    def register(self, rid:str, priority:str):
+        with self.lock:
+            self.weights[rid] = PRIORITY_WEIGHTS.get(priority, 1.0)
+            self.cancelled_ids.discard(rid)
+
+    def unregister(self, rid:str):
+        with self.lock:
+            self.weights.pop(rid, None)
+            self.cancelled_ids.discard(rid)
+        for lim in self.limiters:
+            lim.forget(rid)
+
+    def weight(self, rid:str) -> float:
+        return self.weights.get(rid, 1.0)
+
+    def cancel(self, rid:str) -> bool:
+        """只对本进程在执行的任务生效；返回是否找到"""
+        with self.lock:
+            if rid not in self.weights:
+                return False
+            self.cancelled_ids.add(rid)
+        for lim in self.limiters + self.breakers:   # 排队拿窗口、等熔断恢复的线程都叫醒
+            lim.wake()
+        return True
+
+    def cancelled(self, rid:str) -> bool:
+        return rid in self.cancelled_ids
+
+    def active(self) -> Dict[str,float]:
+        with self.lock:
+            return dict(self.weights)
+
+SCHED = RunScheduler()
+
+class AdaptiveLimiter:
+    """AIMD 并发窗口：成功且延迟健康时每轮 +1；429/5xx/限流头时减半并按 Retry-After 暂停；其他错误或延迟恶化时小幅收缩。
+    窗口由本进程所有任务共享：同一任务内先来先得，任务之间按优先级权重轮转（stride 调度），大批量任务不会堵住后来的小任务"""
+    def __init__(self, start:int, lo:int, hi:int, rpm:float=0.0):
+        self.limit, self.lo, self.hi = float(start), lo, hi
+        self.inflight = 0
+        self.pause_until = 0.0
+        self.base_lat = None
+        self.ewma_lat = None
+        self.cond = threading.Condition()
+        self.gap, self.next_at = (60.0 / rpm if rpm > 0 else 0.0), 0.0
+        self.waiting: Dict[str,deque] = {}   # rid -> 排队中的请求（先来先得）
+        self.vtime: Dict[str,float] = {}     # rid -> 虚拟时间：每拿一次窗口 +1/权重，最小的先拿
+        self.vclock = 0.0
+        SCHED.limiters.append(self)
+
+    @property
+    def window(self) -> int:
+        return int(self.limit)
+
+    def _head(self):
+        rid = min(self.waiting, key=lambda r: self.vtime[r])
+        return self.waiting[rid][0]
+
+    def acquire(self) -> bool:
+        """拿到窗口返回 True；所属任务已取消时返回 False（不占窗口）"""
+        rid, me = RUN_ID.get(), object()
+        with self.cond:
+            if rid not in self.waiting:
+                # 空闲后回来的任务从当前虚拟时钟起算，不能攒份额
+                self.vtime[rid] = max(self.vtime.get(rid, 0.0), self.vclock)
+            q = self.waiting.setdefault(rid, deque())
+            q.append(me)
+            granted = False
+            try:
+                while not SCHED.cancelled(rid):
+                    wait = max(self.pause_until, self.next_at) - time.time()
+                    if wait > 0:
+                        self.cond.wait(wait)
+                    elif self.inflight < int(self.limit) and self._head() is me:
+                        granted = True
+                        break
+                    else:
+                        self.cond.wait(1.0)
+            finally:
+                q.remove(me)
+                if not q:
+                    del self.waiting[rid]
+                self.cond.notify_all()   # 队头变了
+            if not granted:
+                return False
+            self.vclock = self.vtime[rid]
+            self.vtime[rid] += 1.0 / SCHED.weight(rid)
+            if self.gap:
+                self.next_at = max(self.next_at, time.time()) + self.gap
+            self.inflight += 1
+            return True
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def forget(self, rid:str):
+        with self.cond:
+            if rid not in self.waiting:
+                self.vtime.pop(rid, None)
+
+    def queued(self) -> Dict[str,int]:
+        with self.cond:
+            return {rid: len(q) for rid, q in self.waiting.items()}
+
+    def release(self, ok:bool, latency:float, throttled:bool=False, retry_after:float=0.0):
+        with self.cond:
+            self.inflight -= 1
+            if throttled:
+                self.limit = max(self.lo, self.limit / 2)
+                if retry_after:
+                    self.pause_until = max(self.pause_until, time.time() + retry_after)
+            elif not ok:
+                self.limit = max(self.lo, self.limit * 0.75)
+            else:
+                self.ewma_lat = latency if self.ewma_lat is None else 0.8*self.ewma_lat + 0.2*latency
+                self.base_lat = latency if self.base_lat is None else min(self.base_lat*1.01, latency)
+                if self.ewma_lat > 2.5 * self.base_lat:
+                    self.limit = max(self.lo, self.limit * 0.9)
+                else:
+                    self.limit = min(self.hi, self.limit + 1.0/self.limit)
+            self.cond.notify_all()
+
+LIMITER = AdaptiveLimiter(CONCURRENCY, 1, MAX_CONCURRENCY, LLM_RPM)
+
+class CircuitBreaker:
+    """连续 fails 次服务端故障（5xx/超时/连不上）即熔断：cooldown 秒内暂停派发（调用方阻塞等待，而不是把队列耗成失败），
+    到点放行一个探测请求，服务有响应即恢复，否则再熔断一轮"""
+    def __init__(self, fails:int, cooldown:float):
+        self.fails, self.cooldown = fails, cooldown
+        self.streak = 0
+        self.open_until = 0.0   # 0 = 闭合
+        self.probing = False
+        self.cond = threading.Condition()
+        SCHED.breakers.append(self)
+
+    @property
+    def state(self) -> str:
+        return "closed" if not self.open_until else "half_open" if self.probing else "open"
+
+    def wait(self, deadline:float):
+        """返回 (可否派发, 是否为探测请求)；等到 deadline 仍在熔断或所属任务已取消则不可派发"""
+        with self.cond:
+            while self.open_until:
+                now = time.time()
+                if now >= deadline or SCHED.cancelled(RUN_ID.get()):
+                    return False, False
+                if now >= self.open_until and not self.probing:
+                    self.probing = True
+                    return True, True
+                self.cond.wait(max(0.05, min(deadline, self.open_until if now < self.open_until else now + 1) - now))
+            return True, False
+
+    def cancel_probe(self):
+        with self.cond:
+            self.probing = False
+            self.cond.notify_all()
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def record(self, alive:bool, probe:bool=False) -> Optional[str]:
+        """alive：服务端给出了非 5xx 响应。返回状态变化 "open" / "closed"，无变化返回 None"""
+        with self.cond:
+            change = None
+            if alive:
+                self.streak = 0
+                if self.open_until:
+                    self.open_until, change = 0.0, "closed"
+            else:
+                self.streak += 1
+                if probe or (not self.open_until and self.streak >= self.fails):
+                    change = None if self.open_until else "open"
+                    self.open_until = time.time() + self.cooldown
+            if probe:
+                self.probing = False
+            self.cond.notify_all()
+            return change
+
+BREAKER = CircuitBreaker(BREAKER_FAILS, BREAKER_COOLDOWN_S)
+HEDGE_POOL = ThreadPoolExecutor(4 * MAX_CONCURRENCY, thread_name_prefix="hedge") if HEDGE else None
+_HEDGES = {"inflight":0, "lock":threading.Lock()}
+HEDGE_MAX = max(1, MAX_CONCURRENCY // 4)   # 对冲请求不占并发窗口，单独限量
+class ModelTier:
+    """一档模型：各自的地址/Key/模型名、并发窗口与熔断"""
+    def __init__(self, name:str, base_url:str, api_key:str, model:str, limiter:AdaptiveLimiter, breaker:CircuitBreaker):
+        self.name, self.base_url, self.api_key, self.model = name, base_url, api_key, model
+        self.limiter, self.breaker = limiter, breaker
+        self.p95, self.ok_n = 0.0, 0   # 近期成功请求延迟 p95，对冲阈值
+
+FULL = ModelTier("full", MODEL_BASE_URL, MODEL_API_KEY, MODEL_NAME, LIMITER, BREAKER)
+FAST = ModelTier("fast", FAST_BASE_URL, FAST_API_KEY, FAST_MODEL_NAME,
+                 AdaptiveLimiter(FAST_CONCURRENCY, 1, FAST_MAX_CONCURRENCY, FAST_RPM),
+                 CircuitBreaker(BREAKER_FAILS, BREAKER_COOLDOWN_S)) if CASCADE else None
+
+HTTP = requests.Session()
+HTTP.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=(MAX_CONCURRENCY + (FAST_MAX_CONCURRENCY if CASCADE else 0))*2))
+HTTP.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=(MAX_CONCURRENCY + (FAST_MAX_CONCURRENCY if CASCADE else 0))*2))
+
+def _duration(v:str) -> float:
+    """解析 Retry-After / x-ratelimit-reset-* ：'7'、'1.5s'、'6m0s'、'120ms'"""
+    v = (v or "").strip()
+    if not v:
+        return 0.0
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
+        return float(v)
+    except ValueError:
+        pass
+    total = 0.0
+    for num, unit in re.findall(r"([\d.]+)(ms|h|m|s)", v):
+        total += float(num) * {"ms":0.001, "s":1, "m":60, "h":3600}[unit]
+    return total
+
+def throttle_hint(r: requests.Response):
+    """返回 (是否限流, 建议暂停秒数)"""
+    retry_after = _duration(r.headers.get("Retry-After", ""))
+    if r.status_code == 429 or r.status_code >= 500:
+        return True, retry_after
+    if r.headers.get("x-ratelimit-remaining-requests", "").strip() == "0":
+        return True, retry_after or _duration(r.headers.get("x-ratelimit-reset-requests", ""))
+    return False, 0.0
+
+_JSON_MODE_OK = JSON_MODE != "off"   # auto 模式下遇到服务端拒绝 response_format 即置 False
+
+def _request(tier:ModelTier, payload:Dict[str,Any], timeout:float, probe:bool=False, slot:str="acquire"):
+    """单次 HTTP 请求。slot：acquire 先占并发窗口 / held 调用方已占 / none 不占（对冲请求）。
+    返回 (内容或 None, 可否重试, 建议等待秒数)"""
+    global _JSON_MODE_OK
+    url = f"{tier.base_url}/v1/chat/completions"
+    headers = {"Authorization": f"Bearer {tier.api_key}", "Content-Type": "application/json"}
+    if slot == "acquire" and not tier.limiter.acquire():
+        if probe:   # 探测请求没发出去，交还给下一个调用方
+            tier.breaker.cancel_probe()
+        inc("llm_requests_total", outcome="cancelled", tier=tier.name)
+        return None, False, 0.0
+    t0, ok, throttled, retry_after, outcome, alive = time.time(), False, False, 0.0, "ok", False
+    try:
+        r = HTTP.post(url, headers=headers, json=payload, timeout=(min(10.0, timeout), timeout))
+        if (r.status_code in (400, 422) and "response_format" in payload and JSON_MODE == "auto"
+                and re.search(r"response_format|json_object|json mode", r.text, re.I)):   # 其他 400（如超长）按普通错误处理
+            logging.warning("JSON mode rejected (%s), disabled: %s", r.status_code, r.text[:200])
+            _JSON_MODE_OK = False
+            payload.pop("response_format")
+            r = HTTP.post(url, headers=headers, json=payload, timeout=(min(10.0, timeout), timeout))
+        alive = r.status_code < 500
+        throttled, retry_after = throttle_hint(r)
         r.raise_for_status()
         data = r.json()
-        return data["choices"][0]["message"]["content"]
+        content = data["choices"][0]["message"]["content"]
+        usage = data.get("usage") or {}
+        inc("llm_prompt_tokens_total", usage.get("prompt_tokens") or 0)
+        inc("llm_completion_tokens_total", usage.get("completion_tokens") or 0)
+        ok = True
+        return content, False, 0.0
     except Exception as e:
-        logging.warning("LLM call failed: %s", e)
+        # 失败原因按类别计数（http_429 / ReadTimeout / KeyError…），不再只表现为“解析失败”
+        code = getattr(getattr(e, "response", None), "status_code", None)
+        outcome = f"http_{code}" if code else type(e).__name__
+        logging.warning("LLM call failed (%s): %s", outcome, e)
+        return None, code is None or code in (408, 409, 429) or code >= 500, retry_after
+    finally:
+        dt = time.time() - t0
+        if slot != "none":
+            tier.limiter.release(ok, dt, throttled, retry_after)
+        inc("llm_requests_total", outcome=outcome, tier=tier.name)
+        observe("llm_latency_seconds", dt, outcome="ok" if ok else "error", tier=tier.name)
+        if ok:
+            tier.ok_n += 1
+            if tier.ok_n % 10 == 0:
+                tier.p95 = METRICS.hist("llm_latency_seconds", outcome="ok", tier=tier.name)["p95"]
+        change = tier.breaker.record(alive, probe)
+        if change:
+            inc("breaker_transitions_total", to=change, tier=tier.name)
+            label = "快速档" if tier is FAST else ""
+            msg = (f"⚠ {label}模型服务连续故障，熔断：暂停派发 {tier.breaker.cooldown:.0f}s 后试探恢复" if change == "open"
+                   else f"✓ {label}模型服务已恢复，继续派发")
+            logging.warning(msg)
+            if RUN_ID.get():
+                put(RUN_ID.get(), msg)
+
+def _hedged(tier:ModelTier, payload:Dict[str,Any], timeout:float, probe:bool):
+    """超过近期 p95 仍未返回时补发一份（不占并发窗口，同时在途最多 HEDGE_MAX 份），取先成功的；落后的那份在后台跑完"""
+    if not HEDGE_POOL or probe or tier.ok_n < 20 or tier.p95 <= 0 or tier.p95 >= timeout:
+        return _request(tier, payload, timeout, probe)
+    if not tier.limiter.acquire():   # 在本线程排队拿窗口，p95 只从真正发出请求时算起
+        inc("llm_requests_total", outcome="cancelled", tier=tier.name)
+        return None, False, 0.0
+    first = HEDGE_POOL.submit(contextvars.copy_context().run, _request, tier, payload, timeout, False, "held")
+    try:
+        return first.result(timeout=tier.p95)
+    except FutureTimeout:
+        pass
+    with _HEDGES["lock"]:
+        full = _HEDGES["inflight"] >= HEDGE_MAX
+        if not full:
+            _HEDGES["inflight"] += 1
+    if full:
+        return first.result()
+    inc("llm_retries_total", kind="hedge")
+    second = HEDGE_POOL.submit(contextvars.copy_context().run, _request, tier, dict(payload), timeout, False, "none")
+    second.add_done_callback(lambda _: _hedge_done())
+    pending = {first, second}
+    res = (None, True, 0.0)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            res = f.result()
+            if res[0] is not None:
+                if f is second:
+                    inc("llm_retries_total", kind="hedge_won")
+                return res
+    return res
+
+def _hedge_done():
+    with _HEDGES["lock"]:
+        _HEDGES["inflight"] -= 1
+
+def llm_chat(messages: List[Dict[str,str]], temperature: float=0.2, max_tokens:int=1024, json_mode:bool=False,
+             tier:Optional[ModelTier]=None) -> str:
+    """tier 默认完整档。json_mode=True 时请求 response_format=json_object（服务端支持时保证返回一个合法 JSON 对象）。
+    可重试的失败按抖动指数退避重试 LLM_RETRIES 次，整体不超过任务截止时间；熔断期间等待恢复；最终失败返回 """""
+    tier = tier or FULL
+    if not tier.api_key or not tier.base_url:
+        inc("llm_requests_total", outcome="unconfigured", tier=tier.name)
         return ""
+    payload = {"model": tier.model, "messages": messages, "temperature": temperature,
+               "max_tokens": max_tokens, "stream": False}
+    if json_mode and _JSON_MODE_OK:
+        payload["response_format"] = {"type": "json_object"}
+    deadline = RUN_DEADLINE.get() or float("inf")
+    for attempt in range(LLM_RETRIES + 1):
+        if SCHED.cancelled(RUN_ID.get()):
+            return ""
+        go, probe = tier.breaker.wait(deadline - 1)
+        left = deadline - time.time()
+        if not go or left <= 1:
+            if probe:
+                tier.breaker.cancel_probe()
+            if not SCHED.cancelled(RUN_ID.get()):
+                inc("llm_requests_total", outcome="deadline", tier=tier.name)
+            return ""
+        content, retryable, retry_after = _hedged(tier, payload, min(LLM_TIMEOUT, left), probe)
+        if content is not None:
+            return content
+        if not retryable or attempt == LLM_RETRIES:
+            return ""
+        delay = max(retry_after, random.uniform(0, RETRY_BASE_S * 2 ** attempt))
+        if time.time() + delay >= deadline:
+            inc("llm_requests_total", outcome="deadline", tier=tier.name)
+            return ""
+        inc("llm_retries_total", kind="retry")
+        time.sleep(delay)
+    return ""
 
 PROMPT_SYS = (
 "你是资深猎头助理。请基于候选人简历文本，输出**严格合法的 JSON**，并做岗位匹配。\n"
@@ -312,7 +1058,33 @@ PROMPT_SYS = (
 "若简历无邮箱，可从文本中正则抽取；不要电话。"
 )
 
-def build_messages(role:str, track:str, note:str, limits:str, must:str, nice:str, text:str)->List[Dict[str,str]]:
+PROMPT_PROFILE = (
+"你是资深猎头助理。请从候选人简历文本中抽取结构化档案，输出**严格合法的 JSON**（只抽取，不针对任何岗位，不打分）。\n"
+"字段：\n"
+"name, current_company, current_title, email, location,\n"
+"age_estimate, tags(list，技能/行业关键词),\n"
+"education(list:{school,major,degree,start,end}),\n"
+"experiences(list:{company,title,start,end,one_line}),\n"
+"remark(中文时间线：如“2012-2016年 就读于XX大学/计算机 本科；2016-2020年 就职于XX公司/工程师，主要负责XXX”，≤120字)。\n"
+"若简历无邮箱，可从文本中正则抽取；不要电话。"
+)
+
+PROMPT_SCORE = (
+"你是资深猎头助理。请根据候选人档案（JSON）与岗位要求做匹配打分，输出**严格合法的 JSON**，字段：\n"
+"score(0-100 数值), grade(A+/A/B/C),\n"
+"fit_summary(中文，概括与岗位的契合要点),\n"
+"risks(中文，概括潜在风险/短板)。\n"
+"打分口径：关键词匹配度 + 最近3年经验相关性 + 平台/影响力。"
+)
+
+PROMPT_FAST = (
+"你是资深猎头助理。只做岗位匹配初筛，输出**严格合法的 JSON**，字段：\n"
+"name, current_company, current_title, score(0-100 数值), grade(A+/A/B/C), fit_summary(中文，≤30字)。\n"
+"打分口径：关键词匹配度 + 最近3年经验相关性 + 平台/影响力。不要输出其他字段。"
+)
+
+def build_messages(role:str, track:str, note:str, limits:str, must:str, nice:str, text:str,
+                   system:str=PROMPT_SYS)->List[Dict[str,str]]:
     user = f"""岗位：{role}
 方向：{track}
 限制：{limits}
@@ -323,7 +1095,60 @@ Nice-to-have：{nice}
 候选人简历文本：
 {text}
 """
-    return [{"role":"system","content":PROMPT_SYS},{"role":"user","content":user}]
+    return [{"role":"system","content":system},{"role":"user","content":user}]
+
+PROMPT_BATCH = (
+"\n本次包含多位候选人，每位以“<<<候选人 ID>>>”开头。请返回 JSON 对象 {\"candidates\": [...]}，数组里每位候选人一个对象，"
+"字段同上，并额外带上 id 字段（原样填写 ID）。不要遗漏、不要合并候选人。"
+)
+
+def build_profile_messages(texts:List[tuple])->List[Dict[str,str]]:
+    """档案抽取不带岗位信息；texts: [(id, 简历文本)]，id 为 None（逐份调用）时不加 ID 标记。
+    批量里只剩一份也要带 ID，否则 llm_json_batch 拆不回来"""
+    if texts[0][0] is None:
+        return [{"role":"system","content":PROMPT_PROFILE},{"role":"user","content":f"候选人简历文本：\n{texts[0][1]}"}]
+    body = "\n\n".join(f"<<<候选人 {cid}>>>\n{t}" for cid, t in texts)
+    return [{"role":"system","content":PROMPT_PROFILE + PROMPT_BATCH},
+            {"role":"user","content":f"候选人简历文本（共 {len(texts)} 位）：\n{body}"}]
+
+_PROFILE_FIELDS = ("name", "current_company", "current_title", "location", "tags", "education", "experiences", "remark")
+
+def build_score_messages(job:Dict[str,str], profiles:List[tuple])->List[Dict[str,str]]:
+    """岗位打分只发档案（比原文短得多）；profiles: [(id, 档案)]，id 为 None 时用逐份格式"""
+    texts = [(cid, json.dumps({k: p.get(k) for k in _PROFILE_FIELDS if p.get(k)}, ensure_ascii=False))
+             for cid, p in profiles]
+    msgs = build_batch_messages(job["role"],job["track"],job["note"],job["limits"],job["must"],job["nice"], texts,
+                                system=PROMPT_SCORE)
+    if texts[0][0] is None:
+        msgs = build_messages(job["role"],job["track"],job["note"],job["limits"],job["must"],job["nice"], texts[0][1],
+                              system=PROMPT_SCORE)
+        msgs[1]["content"] = msgs[1]["content"].replace("候选人简历文本：", "候选人档案：")
+    else:
+        msgs[1]["content"] = msgs[1]["content"].replace("候选人简历文本（", "候选人档案（")
+    return msgs
+
+def build_batch_messages(role:str, track:str, note:str, limits:str, must:str, nice:str,
+                         texts:List[tuple], system:str=PROMPT_SYS)->List[Dict[str,str]]:
+    """多份简历打包成一次请求：系统提示与岗位信息只发一次。texts: [(id, 简历文本)]"""
+    body = "\n\n".join(f"<<<候选人 {cid}>>>\n{t}" for cid, t in texts)
+    user = f"""岗位：{role}
+方向：{track}
+限制：{limits}
+Must-have：{must}
+Nice-to-have：{nice}
+补充说明：{note}
+
+候选人简历文本（共 {len(texts)} 位）：
+{body}
+"""
+    return [{"role":"system","content":system + PROMPT_BATCH},{"role":"user","content":user}]
+
+def estimate_tokens(text:str) -> int:
+    """本地粗估 token 数：中日韩字符约 1 字 1 token，其余约 4 字符 1 token"""
+    cjk = len(re.findall(r"[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+GRADE_CUTS = (90, 80, 70)   # grade_from_score 的分档线
 
 def grade_from_score(s: float) -> str:
     try:
@@ -335,45 +1160,670 @@ def grade_from_score(s: float) -> str:
     if s >= 70: return "B"
     return "C"
 
-# ---------- 主流程 ----------
-def handle_zip_or_file(upload_path: str, work_dir:str) -> List[str]:
-    files = []
-    base,ext = os.path.splitext(os.path.basename(upload_path))
-    if ext.lower()==".zip":
+# ---------- JSON 容错解析 ----------
+_FENCE_RE = re.compile(r"```(?:json)?", re.I)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_UNQUOTED_KEY_RE = re.compile(r'([{,]\s*)([A-Za-z_][\w-]*)\s*:')
+_LITERALS_RE = re.compile(r"\b(True|False|None)\b")
+
+def _close_truncated(s:str) -> str:
+    """被 max_tokens 截断的 JSON：补上未闭合的字符串与括号；不行就退到上一个逗号处（丢掉写了一半的字段）再补"""
+    stack, in_str, esc, cuts = [], False, False, []
+    for i, ch in enumerate(s):
+        if in_str:
+            if esc: esc = False
+            elif ch == "\\": esc = True
+            elif ch == '"': in_str = False
+            continue
+        if ch == '"':
+            in_str = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+        elif ch == ",":
+            cuts.append((i, list(stack)))
+    if not stack and not in_str:
+        return s
+    # 停在数字/字面量中间的（如分数 "score": 7 可能本是 75）不直接补括号，退到上一个逗号
+    whole = [(s + ('"' if in_str else ""), stack)] if in_str or s.rstrip()[-1:] in "}]" else []
+    for body, st in whole + [(s[:i], st) for i, st in reversed(cuts[-20:])]:
+        cand = _TRAILING_COMMA_RE.sub(r"\1", body.rstrip().rstrip(":") + "".join(reversed(st)))
         try:
-            with zipfile.ZipFile(upload_path) as z:
-                z.extractall(work_dir)
-            for root,_,fs in os.walk(work_dir):
-                for f in fs:
-                    if os.path.splitext(f)[1].lower() in (".pdf",".html",".htm",".txt",".docx"):
-                        files.append(os.path.join(root,f))
-        except Exception as e:
-            logging.warning("unzip error %s: %s", upload_path, e)
-    else:
-        files.append(upload_path)
-    return files
-
-def process_resume(path:str, role:str, track:str, note:str, limits:str, must:str, nice:str)->Dict[str,Any]:
-    text = text_from_file(path)
-    email = extract_email(text)
-    msg = build_messages(role,track,note,limits,must,nice,text[:12000])
-    content = llm_chat(msg, temperature=0.2, max_tokens=900)
-    data = {}
-    if content:
+            json.loads(cand)
+            return cand
+        except ValueError:
+            continue
+    return s
+
+_DECODER = json.JSONDecoder()
+
+def parse_json_lenient(content:str):
+    """容错解析模型输出：代码块 / 前后说明文字 / 尾逗号 / 未加引号的键 / Python 字面量 / 截断。
+    返回 (对象, 是否经过修复)；无法解析时返回 (None, True)"""
+    text = (content or "").strip()
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+    text = _FENCE_RE.sub("", text).strip()
+    starts = [k for k in (text.find("{"), text.find("[")) if k >= 0]
+    if starts:
+        text = text[min(starts):]
+        try:   # 后面跟着说明文字（说明里也可能有括号）：读出第一个完整的值，后面的不管
+            return _DECODER.raw_decode(text)[0], True
+        except ValueError:
+            pass
+    for fix in (lambda t: t,
+                lambda t: _TRAILING_COMMA_RE.sub(r"\1", t),
+                lambda t: _UNQUOTED_KEY_RE.sub(r'\1"\2":', _TRAILING_COMMA_RE.sub(r"\1", t)),
+                lambda t: _LITERALS_RE.sub(lambda m: {"True":"true", "False":"false", "None":"null"}[m.group(1)],
+                                           _UNQUOTED_KEY_RE.sub(r'\1"\2":', _TRAILING_COMMA_RE.sub(r"\1",
+                                           t if '"' in t else t.replace("'", '"'))))):
+        t = fix(text)
+        for cand in (t, _close_truncated(t)):
+            try:
+                return _DECODER.raw_decode(cand)[0], True
+            except ValueError:
+                continue
+    return None, True
+
+_STR_FIELDS = ("name", "current_company", "current_title", "email", "location", "age_estimate",
+               "fit_summary", "risks", "remark", "grade")
+
+def coerce_result(d:Any, need_score:bool=True) -> Optional[Dict[str,Any]]:
+    """按字段类型纠正单个候选人的结果（“85分”→85、标签字符串→列表、单个对象→列表…）；
+    need_score 时没有可用分数返回 None，交给兜底调用；档案（need_score=False）连姓名/履历/教育都没有的返回 None"""
+    if not isinstance(d, dict):
+        return None
+    if not need_score and len(d) == 1 and isinstance(next(iter(d.values())), dict):   # {"profile":{...}} 之类的包装
+        d = next(iter(d.values()))
+    for k in _STR_FIELDS:
+        v = d.get(k)
+        if isinstance(v, list):
+            d[k] = "；".join(str(x) for x in v if x)
+        elif v is not None and not isinstance(v, str):
+            d[k] = str(v)
+    tags = d.get("tags")
+    if isinstance(tags, str):
+        d["tags"] = [t.strip() for t in re.split(r"[,，、;；/]", tags) if t.strip()]
+    elif not isinstance(tags, list):
+        d["tags"] = []
+    for k in ("education", "experiences"):
+        v = d.get(k)
+        d[k] = [v] if isinstance(v, dict) else [x for x in v if isinstance(x, dict)] if isinstance(v, list) else []
+    if not need_score:   # 空档案不能进缓存，否则之后每次重评都拿它打分
+        return d if str(d.get("name") or "").strip() or d["experiences"] or d["education"] else None
+    sc = d.get("score")
+    if isinstance(sc, str):
+        m = re.search(r"\d+(\.\d+)?", sc)
+        sc = float(m.group()) if m else None
+    if isinstance(sc, bool) or not isinstance(sc, (int, float)):
+        return None
+    d["score"] = max(0.0, min(100.0, float(sc)))
+    return d
+
+def rank_key(row:Dict[str,Any]):
+    """榜单排序：已评估的按分数降序在前，未评估的按本地分降序在后"""
+    evaluated = row.get("grade") != "未评估"
+    return (not evaluated, -float(row.get("score") or 0) if evaluated else -float(row.get("local_score") or 0))
+
+# ---------- 结果缓存 ----------
+class DiskCache:
+    """SQLite 磁盘缓存，按内容哈希寻址，TTL + LRU 淘汰；一张表一个实例"""
+    def __init__(self, path:str, ttl_s:float, max_entries:int, table:str):
+        self.ttl, self.max_entries, self.table = ttl_s, max_entries, table
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (k TEXT PRIMARY KEY, v TEXT NOT NULL, ts REAL NOT NULL, hit_ts REAL NOT NULL)")
+        self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_hit ON {table}(hit_ts)")
+        self.evict()
+
+    def get(self, k:str):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(f"SELECT v, ts FROM {self.table} WHERE k=?", (k,)).fetchone()
+            if not row:
+                return None
+            if now - row[1] > self.ttl:
+                self.db.execute(f"DELETE FROM {self.table} WHERE k=?", (k,))
+                return None
+            self.db.execute(f"UPDATE {self.table} SET hit_ts=? WHERE k=?", (now, k))
+        return json.loads(row[0])
+
+    def set(self, k:str, v:Dict[str,Any]):
+        now = time.time()
+        with self.lock:
+            self.db.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?,?,?,?)",
+                            (k, json.dumps(v, ensure_ascii=False), now, now))
+            self.writes += 1
+            if self.writes % 200 == 0:
+                self._evict_locked()
+
+    def evict(self):
+        with self.lock:
+            self._evict_locked()
+
+    def _evict_locked(self):
+        self.db.execute(f"DELETE FROM {self.table} WHERE ts < ?", (time.time() - self.ttl,))
+        n = self.db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        if n > self.max_entries:
+            self.db.execute(f"DELETE FROM {self.table} WHERE k IN (SELECT k FROM {self.table} ORDER BY hit_ts LIMIT ?)",
+                            (n - self.max_entries,))
+
+CACHE_DB = os.path.join(DATA_DIR, "cache.sqlite3")
+CACHE      = DiskCache(CACHE_DB, CACHE_TTL_DAYS*86400, CACHE_MAX_ENTRIES, "llm_cache") if CACHE_MAX_ENTRIES > 0 else None
+TEXT_CACHE = DiskCache(CACHE_DB, CACHE_TTL_DAYS*86400, CACHE_MAX_ENTRIES, "text_cache") if CACHE_MAX_ENTRIES > 0 else None
+
+def profile_key(text:str) -> str:
+    """档案缓存只看简历正文，与岗位条件无关"""
+    raw = json.dumps([PROFILE_VERSION, MODEL_NAME, text], ensure_ascii=False)
+    return "profile:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def cache_key(text:str, role:str, track:str, note:str, limits:str, must:str, nice:str) -> str:
+    # 两步打分的结果还取决于档案提示词与打分提示词，和单次调用的结果分开存
+    flow = f"split:{PROFILE_VERSION}" if SPLIT_PROFILE else "single"
+    raw = json.dumps([PROMPT_VERSION, flow, MODEL_NAME, role, track, note, limits, must, nice, text], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+# ---------- 文档解析 ----------
+PARSER_VERSION = "p2"   # 修改 text_from_bytes 的抽取逻辑时递增，旧文本缓存自动失效
+
+class ParsePool:
+    """解析子进程池：pdfminer/BeautifulSoup 的 CPU 活不再占用 Web 进程的 GIL；单文件超时即杀掉并重建进程池"""
+    def __init__(self, procs:int, timeout:float):
+        self.procs, self.timeout = procs, timeout
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(procs)   # 在途不超过进程数：超时只计真正在解析的时间，不含排队
+        self.ex: Optional[ProcessPoolExecutor] = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.ex is None:
+                self.ex = ProcessPoolExecutor(self.procs, mp_context=multiprocessing.get_context("spawn"))
+            return self.ex
+
+    def _reset(self, ex:ProcessPoolExecutor):
+        with self.lock:
+            if self.ex is not ex:
+                return
+            self.ex = None
+        for p in list((getattr(ex, "_processes", None) or {}).values()):
+            p.kill()
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    def extract(self, raw:bytes, ext:str, name:str="") -> str:
+        for _ in range(2):
+            with self.slots:
+                ex = self._pool()
+                fut = ex.submit(text_from_bytes, raw, ext, name)
+                try:
+                    return fut.result(timeout=self.timeout)
+                except FutureTimeout:
+                    logging.warning("parse timeout %.0fs: %s", self.timeout, name)
+                    self._reset(ex)
+                    return ""
+                except BrokenProcessPool:
+                    self._reset(ex)   # 多半是别的文件超时被杀，换新池重试一次
+        return ""
+
+PARSER = ParsePool(PARSE_PROCS, PARSE_TIMEOUT) if PARSE_PROCS > 0 else None
+
+def parse_document(raw:bytes, ext:str, name:str="", sha:str="") -> Dict[str,Any]:
+    """解析单个文件：先查文本缓存（按文件内容哈希），未命中再交给解析进程池；返回 text/ext/parse_s/text_cached"""
+    ext = ext.lower()
+    t0 = time.time()
+    key = None
+    if TEXT_CACHE:
+        key = f"{PARSER_VERSION}:{PARSE_MAX_PAGES}:{sha or hashlib.sha256(raw).hexdigest()}"
+        text = TEXT_CACHE.get(key)
+        if text is not None:
+            observe("extract_seconds", time.time()-t0, ext=ext.lstrip("."), source="cache")
+            return {"text":text, "ext":ext, "parse_s":time.time()-t0, "text_cached":True}
+    text = PARSER.extract(raw, ext, name) if PARSER and ext in (".pdf",".docx",".html",".htm") \
+           else text_from_bytes(raw, ext, name)
+    if key and text:
+        TEXT_CACHE.set(key, text)
+    observe("extract_seconds", time.time()-t0, ext=ext.lstrip("."), source="parse")
+    if not text:
+        inc("extract_empty_total", ext=ext.lstrip("."))
+    return {"text":text, "ext":ext, "parse_s":time.time()-t0, "text_cached":False}
+
+# ---------- 简历压缩 ----------
+_BOILERPLATE_RE = re.compile(
+    r"^(page \d+ of \d+|第\s*\d+\s*页.*|\d{1,3}\s*/\s*\d{1,3}|contact|联系方式|show all.*|see more|…\s*see more|显示全部.*|查看更多"
+    r"|skip to main content|home|my network|jobs|messaging|notifications|sign in|join now|me|for business"
+    r"|report this profile|people also viewed.*|others named.*|more activity by.*|\d+\+? (connections|followers)"
+    r"|\d+\s*(位好友|位关注者)|endorse|message|connect|follow|more|privacy policy|user agreement|cookie policy"
+    r"|©\s*\d{4}.*|linkedin corporation.*|(https?://)?(www\.)?linkedin\.com/\S*)$", re.I)
+
+_SECTION_RES = [
+    ("experience", re.compile(r"^(work )?experience|^employment|^工作经[历验]|^职业经历|^工作履历", re.I)),
+    ("education",  re.compile(r"^education|^教育(经历|背景)|^学历", re.I)),
+    ("skills",     re.compile(r"^(top )?skills|^技能|^专业技能|^核心技能", re.I)),
+    ("summary",    re.compile(r"^summary|^about|^个人简介|^简介|^概述|^自我评价", re.I)),
+    ("other",      re.compile(r"^(certifications?|licenses|languages|honors|awards|publications|projects|volunteer"
+                              r"|interests|recommendations|courses|patents|证书|语言|荣誉|获奖|项目经[历验]|出版物|专利)", re.I)),
+]
+# 预算分两轮：先按配额保证每节都有代表（抬头含姓名/当前职位），再按优先级把剩余预算补给靠前的节
+_SECTION_QUOTA = [("header", .10), ("experience", .50), ("education", .15), ("skills", .10), ("summary", .10), ("other", .05)]
+
+_DEDUP_WINDOW = 6   # 只去掉最近几行内的重复（HTML/PDF 相邻重复的文字），远处同样的行多半是真实内容
+
+def compact_resume(text:str, budget:int) -> str:
+    """去掉导航/页码等样板行与相邻重复行，按分节配额把最相关的内容装进 token 预算，输出保持原顺序。
+    工作经历节内不去重：两段经历职位相同也要各自保留"""
+    lines: List[str] = []
+    recent: deque = deque(maxlen=_DEDUP_WINDOW)
+    section, by_section = "header", {name: [] for name, _ in _SECTION_QUOTA}
+    for ln in text.splitlines():
+        ln = re.sub(r"\s+", " ", ln).strip()
+        if not ln or _BOILERPLATE_RE.match(ln):
+            continue
+        if len(ln) <= 40:
+            for name, rx in _SECTION_RES:
+                if rx.match(ln):
+                    section = name
+                    break
+        k = ln.lower()
+        if section != "experience" and k in recent:
+            continue
+        recent.append(k)
+        by_section[section].append(len(lines))
+        lines.append(ln)
+
+    keep: Dict[int,str] = {}
+    pos = {name: 0 for name in by_section}   # 每节下一行的位置（节内按原顺序取，最近的经历一般在前）
+    used = 0
+    def take(name:str, cap:int, truncate:bool):
+        nonlocal used
+        idxs = by_section[name]
+        while pos[name] < len(idxs):
+            ln = lines[idxs[pos[name]]]
+            cost = estimate_tokens(ln) + 1
+            room = min(cap, budget - used)
+            if cost > room:
+                if truncate and room > 20:   # 预算尾巴：截一段进去
+                    keep[idxs[pos[name]]] = ln[:len(ln) * (room - 1) // cost]
+                    used += room
+                    pos[name] += 1
+                return
+            keep[idxs[pos[name]]] = ln
+            used += cost
+            cap -= cost
+            pos[name] += 1
+    for name, quota in _SECTION_QUOTA:
+        take(name, int(budget * quota), False)
+    for name, _ in _SECTION_QUOTA:
+        take(name, budget, True)
+    return "\n".join(keep[i] for i in sorted(keep))
+
+# ---------- 本地关键词预排 ----------
+class KeywordRanker:
+    """按表单关键词给简历打本地分：Must 权重 3、Nice 1.5、职位/方向 1、补充说明 0.5；
+    词频做 BM25 式饱和 tf/(tf+k1)，同一个词出现再多也封顶。按总权重归一：所有词各出现一次约 45 分，
+    各 3 次约 71 分，100 只是渐近上限（表单的阈值提示按此写）。毫秒级，不调用 LLM。"""
+    K1 = 1.2
+
+    def __init__(self, job:Dict[str,str]):
+        terms: Dict[str,float] = {}
+        def add(text:str, w:float, free:bool=False):
+            parts = re.findall(r"[\u4e00-\u9fff]{2,}|[A-Za-z][A-Za-z0-9+#.\-]+", text or "")[:30] if free \
+                    else re.split(r"[,，、;；|\n]+", text or "")   # 不按 / 拆：CI/CD、TCP/IP 是一个词
+            for p in parts:
+                p = p.strip().lower()
+                if p:
+                    terms[p] = max(terms.get(p, 0.0), w)
+        add(job["must"], 3.0); add(job["nice"], 1.5)
+        add(job["role"], 1.0, True); add(job["track"], 1.0, True); add(job["note"], 0.5, True)
+        # 纯英文/数字词按词边界匹配，避免 "go" 命中 "google"；中文等按子串匹配
+        self.terms = [(re.compile(r"(?<![a-z0-9])" + re.escape(t) + r"(?![a-z0-9])") if re.fullmatch(r"[a-z0-9 ./+#\-]+", t)
+                       else re.compile(re.escape(t)), w) for t, w in terms.items()]
+        self.total = sum(w for _, w in self.terms)
+
+    def score(self, text:str) -> float:
+        if not self.total:
+            return 0.0
+        low = text.lower()
+        acc = 0.0
+        for rx, w in self.terms:
+            tf = len(rx.findall(low))
+            acc += w * tf / (tf + self.K1)
+        return round(100 * acc / self.total, 1)
+
+# ---------- 近似去重（MinHash + LSH） ----------
+MINHASH_PERMS, LSH_BANDS = 64, 16          # 16 个 band × 4 行：Jaccard 0.7 时召回约 99%
+MIN_SHINGLES = 20                          # 文本太短（多半解析失败）不参与去重
+_mh_rng = random.Random(61)                # 固定种子，签名在进程间一致
+_MH_MASKS = [_mh_rng.getrandbits(64) for _ in range(MINHASH_PERMS)]
+_TOKEN_RE = re.compile(r"[\u4e00-\u9fff]|[a-z0-9]+")
+
+def shingles(text:str, k:int=3) -> set:
+    """词级 k-shingle（中文按字），哈希成 64 位整数"""
+    toks = _TOKEN_RE.findall(text.lower())
+    return {int.from_bytes(hashlib.blake2b(" ".join(toks[i:i+k]).encode(), digest_size=8).digest(), "little")
+            for i in range(len(toks) - k + 1)}
+
+def minhash(sh:set) -> tuple:
+    # shingle 已是均匀的 64 位哈希，异或随机掩码即可充当一组置换；min(map(...)) 全程在 C 层执行
+    return tuple(min(map(m.__xor__, sh)) for m in _MH_MASKS)
+
+class NearDupIndex:
+    """单次任务内的近似重复索引：LSH 分桶找候选，再用签名估计的 Jaccard 复核"""
+    def __init__(self, threshold:float):
+        self.threshold = threshold
+        self.rows = MINHASH_PERMS // LSH_BANDS
+        self.buckets: Dict[tuple, List[int]] = {}
+        self.entries: List[tuple] = []       # (签名, 标签)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def signature(text:str) -> Optional[tuple]:
+        sh = shingles(text)
+        return minhash(sh) if len(sh) >= MIN_SHINGLES else None
+
+    def match_or_add(self, sig:Optional[tuple], label:str):
+        """命中已有文档返回 (其标签, 相似度)；否则登记本文档并返回 None"""
+        if not sig:
+            return None
+        keys = [(b, sig[b*self.rows:(b+1)*self.rows]) for b in range(LSH_BANDS)]
+        with self.lock:
+            cands = {j for k in keys for j in self.buckets.get(k, ())}
+            best, best_sim = None, 0.0
+            for j in cands:
+                other = self.entries[j][0]
+                sim = sum(x == y for x, y in zip(sig, other)) / MINHASH_PERMS
+                if sim > best_sim:
+                    best, best_sim = j, sim
+            if best is not None and best_sim >= self.threshold:
+                return self.entries[best][1], best_sim
+            self.entries.append((sig, label))
+            for k in keys:
+                self.buckets.setdefault(k, []).append(len(self.entries) - 1)
+        return None
+
+# ---------- 流水线 ----------
+_EOS = object()
+
+class Stage:
+    """流水线的一级：workers 个线程从入队列取件，fn(item) 产出（yield）交给下一级；
+    flush() 在本级全部线程收尾后调用，可补发缓存在本级的件"""
+    def __init__(self, name:str, fn:Callable, workers:int=1, flush:Optional[Callable]=None):
+        self.name, self.fn, self.workers, self.flush = name, fn, max(1, workers), flush
+
+def run_pipeline(source:Iterable[Dict[str,Any]], stages:List[Stage], sink:Callable, maxsize:int=16):
+    """source → stages → sink。相邻级之间为有界队列，下游慢时上游自动背压；
+    某级抛异常时该件带上 _error 直接送到 sink。sink 在调用线程里执行，全部处理完才返回。"""
+    qs = [Queue(maxsize) for _ in range(len(stages)+1)]
+
+    def feed():
         try:
-            data = json.loads(re.sub(r"```json|```","",content).strip())
-        except Exception:
-            content2 = llm_chat(
-                [{"role":"system","content":"仅返回合法 JSON。"},
-                 {"role":"user","content":content}], 0.0, 600
-            )
+            for it in source:
+                qs[0].put(it)
+        except Exception as e:
+            logging.warning("pipeline source error: %s", e)
+        finally:
+            qs[0].put(_EOS)
+
+    def work(st:Stage, qin:Queue, qout:Queue, left:List[int], lock:threading.Lock):
+        while True:
+            it = qin.get()
+            if it is _EOS:
+                qin.put(_EOS)   # 让同级其他线程也能收尾
+                break
+            busy, t = 0.0, time.perf_counter()   # 只计本级自身耗时，不含等下游队列
             try:
-                data = json.loads(re.sub(r"```json|```","",content2).strip())
-            except Exception:
-                data = {}
+                for out in st.fn(it):
+                    busy += time.perf_counter() - t
+                    qout.put(out)
+                    t = time.perf_counter()
+                busy += time.perf_counter() - t
+                observe("stage_seconds", busy, stage=st.name)
+            except Exception as e:
+                inc("stage_errors_total", stage=st.name)
+                logging.warning("stage %s error: %s", st.name, e)
+                for x in it.get("batch") or [it]:   # 打包的件拆开逐个报错，sink 只认单份简历
+                    x["_error"] = f"{st.name}: {e}"
+                    qs[-1].put(x)
+        with lock:
+            left[0] -= 1
+            last = left[0] == 0
+        if last:
+            try:
+                for out in (st.flush() if st.flush else ()):
+                    qout.put(out)
+            except Exception as e:
+                logging.warning("stage %s flush error: %s", st.name, e)
+            qout.put(_EOS)
+
+    # 各线程带上调用方的 contextvars（如当前任务的指标）
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(feed,), daemon=True)]
+    for i, st in enumerate(stages):
+        left, lock = [st.workers], threading.Lock()
+        threads += [threading.Thread(target=contextvars.copy_context().run, args=(work, st, qs[i], qs[i+1], left, lock),
+                                     daemon=True, name=f"{st.name}-{k}") for k in range(st.workers)]
+    for t in threads:
+        t.start()
+    while True:
+        it = qs[-1].get()
+        if it is _EOS:
+            break
+        sink(it)
+
+# ---------- 主流程 ----------
+def _member_name(info:zipfile.ZipInfo) -> str:
+    """未带 UTF-8 标志的成员名按 cp437 解出来是乱码，中文 Windows 导出的多为 GBK"""
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode("gbk")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+def count_upload(upload_path:str) -> int:
+    """待处理文件数（只读 ZIP 目录，不解压）"""
+    if os.path.splitext(upload_path)[1].lower() != ".zip":
+        return int(os.path.splitext(upload_path)[1].lower() in SUPPORTED_EXT)
+    try:
+        with zipfile.ZipFile(upload_path) as z:
+            return sum(1 for i in z.infolist() if not i.is_dir() and os.path.splitext(i.filename)[1].lower() in SUPPORTED_EXT)
+    except Exception:
+        return 0
+
+def iter_upload(upload_path:str, seen:set, stats:Dict[str,int]) -> Iterator[Dict[str,Any]]:
+    """逐个产出上传文件里的简历：ZIP 成员直接读进内存（不落盘），不支持的类型不解压，按内容哈希去重。
+    产出 {src, name, ext, raw, sha}"""
+    base = os.path.basename(upload_path)
+    ext = os.path.splitext(base)[1].lower()
+    if ext != ".zip":
+        if ext in SUPPORTED_EXT:
+            with open(upload_path, "rb") as f:
+                raw = f.read()
+            yield from _dedupe_raw(base, base, ext, raw, seen, stats)
+        return
+    try:
+        with zipfile.ZipFile(upload_path) as z:
+            for info in z.infolist():
+                name = _member_name(info)
+                mext = os.path.splitext(name)[1].lower()
+                if info.is_dir() or mext not in SUPPORTED_EXT:
+                    continue
+                if info.file_size > MAX_MEMBER_MB*1024*1024:
+                    logging.warning("zip member too large %s/%s: %d", base, name, info.file_size)
+                    stats["skipped"] += 1
+                    continue
+                try:
+                    t0 = time.time()
+                    raw = z.read(info)
+                    observe("unzip_seconds", time.time() - t0)
+                    inc("unzip_bytes_total", len(raw))
+                except Exception as e:
+                    logging.warning("zip member error %s/%s: %s", base, name, e)
+                    stats["skipped"] += 1
+                    continue
+                yield from _dedupe_raw(f"{base}/{name}", os.path.basename(name), mext, raw, seen, stats)
+    except Exception as e:
+        logging.warning("unzip error %s: %s", upload_path, e)
+
+def _dedupe_raw(src:str, name:str, ext:str, raw:bytes, seen:set, stats:Dict[str,int]) -> Iterator[Dict[str,Any]]:
+    sha = hashlib.sha256(raw).hexdigest()
+    if sha in seen:
+        stats["dups"] += 1
+        inc("dedupe_skips_total", kind="identical")
+        return
+    seen.add(sha)
+    yield {"src":src, "name":name, "ext":ext, "raw":raw, "sha":sha}
+
+def prepare_resume(item:Dict[str,Any], job:Dict[str,str]) -> Dict[str,Any]:
+    """预处理：抽邮箱、压缩正文、查缓存；未命中时备好 LLM 消息"""
+    text = item["text"]
+    item["email"] = extract_email(text)
+    item["tokens_in"] = estimate_tokens(text)
+    text = compact_resume(text, RESUME_TOKEN_BUDGET)
+    item["tokens_out"] = estimate_tokens(text)
+    item["prompt_text"] = text
+    item["key"] = cache_key(text, **job)
+    item["job"] = job
+    cached = CACHE.get(item["key"]) if CACHE else None
+    item["cached"] = cached is not None
+    item["data"] = cached if cached is not None else {}
+    if not item["cached"]:
+        item["msgs"] = build_messages(job["role"],job["track"],job["note"],job["limits"],job["must"],job["nice"],text)
+    return item
+
+def llm_json(msgs:List[Dict[str,str]], max_tokens:int, need_score:bool=True) -> Dict[str,Any]:
+    """调用并容错解析单个对象；本地修不好才再调一次模型。失败返回 {}"""
+    content = llm_chat(msgs, temperature=0.2, max_tokens=max_tokens, json_mode=True)
+    if not content:
+        return {}
+    obj, repaired = parse_json_lenient(content)
+    data = coerce_result(obj, need_score) or {}
+    if data:
+        inc("json_parse_total", result="repaired_local" if repaired else "ok")
+        return data
+    inc("llm_retries_total", kind="repair")
+    content2 = llm_chat(
+        [{"role":"system","content":"仅返回合法 JSON。"},
+         {"role":"user","content":content}], 0.0, 600, json_mode=True
+    )
+    data = coerce_result(parse_json_lenient(content2)[0], need_score) or {}
+    inc("json_parse_total", result="repaired_llm" if data else "failed")
+    return data
+
+def llm_json_batch(msgs:List[Dict[str,str]], n:int, need_score:bool=True) -> Dict[str,Dict[str,Any]]:
+    """一次请求多位候选人，按 id 拆回；整包解析失败返回 {}"""
+    content = llm_chat(msgs, temperature=0.2, max_tokens=min(8000, 900*n), json_mode=True)
+    by_id: Dict[str,Dict[str,Any]] = {}
+    if not content:
+        return by_id
+    arr, repaired = parse_json_lenient(content)
+    if isinstance(arr, dict):   # {"candidates":[...]}；个别模型换了键名也认
+        arr = next((v for v in arr.values() if isinstance(v, list)), [arr] if "id" in arr else [])
+    if not isinstance(arr, list):
+        inc("json_parse_total", result="failed")
+        logging.warning("batch parse failed (%d items): %s", n, content[:200])
+        return by_id
+    for d in arr:
+        cid = str(d.get("id","")).strip() if isinstance(d, dict) else ""
+        if cid and coerce_result(d, need_score):
+            d.pop("id", None)
+            by_id[cid] = d
+    inc("json_parse_total", result="repaired_local" if repaired else "ok")
+    return by_id
+
+def cached_profile(item:Dict[str,Any]) -> Optional[Dict[str,Any]]:
+    return CACHE.get(profile_key(item["prompt_text"])) if CACHE and "prompt_text" in item else None
+
+def extract_profile(item:Dict[str,Any]) -> Dict[str,Any]:
+    """JD 无关的档案抽取，按简历正文缓存：换岗位条件重评时直接复用"""
+    prof = cached_profile(item)
+    inc("profile_cache_total", result="hit" if prof is not None else "miss")
+    if prof is None:
+        prof = llm_json(build_profile_messages([(None, item["prompt_text"])]), 800, need_score=False)
+        if prof and CACHE:
+            CACHE.set(profile_key(item["prompt_text"]), prof)
+    return prof
+
+def score_resume(item:Dict[str,Any]) -> Dict[str,Any]:
+    """LLM 打分（缓存命中则跳过）。SPLIT_PROFILE 时先取档案（缓存或抽取），再用档案 + 岗位做一次短的打分调用"""
+    if item["cached"]:
+        return item
+    if SPLIT_PROFILE:
+        prof = extract_profile(item)
+        sc = llm_json(build_score_messages(item["job"], [(None, prof)]), 300) if prof else {}
+        data = {**prof, **{k: sc[k] for k in ("score", "grade", "fit_summary", "risks") if k in sc}} if sc else {}
+    else:
+        data = llm_json(item["msgs"], 900)
+    if data and CACHE:
+        CACHE.set(item["key"], data)
+    item["data"] = data
+    item["llm_failed"] = not data
+    return item
+
+def fast_score(item:Dict[str,Any], job:Dict[str,str]) -> Optional[Dict[str,Any]]:
+    """快速档：短提示 + 更短正文，只要分数/等级和抬头信息；结果单独缓存"""
+    key = f"fast:{FAST_MODEL_NAME}:{item['key']}"
+    d = CACHE.get(key) if CACHE else None
+    if d is None:
+        text = compact_resume(item["text"], FAST_TOKEN_BUDGET)
+        msgs = build_messages(job["role"],job["track"],job["note"],job["limits"],job["must"],job["nice"], text,
+                              system=PROMPT_FAST)
+        content = llm_chat(msgs, temperature=0.0, max_tokens=200, json_mode=True, tier=FAST)
+        d = coerce_result(parse_json_lenient(content)[0]) if content else None
+        if d and CACHE:
+            CACHE.set(key, d)
+    return d
+
+def needs_escalation(score:float) -> bool:
+    """高分或贴近分档线的交给完整档重评，其余（大多是 C）快速档结果即终稿"""
+    return score >= ESCALATE_MIN or any(abs(score - c) <= ESCALATE_MARGIN for c in GRADE_CUTS)
+
+def score_batch(items:List[Dict[str,Any]], job:Dict[str,str]) -> int:
+    """一次请求给多份简历打分，按 id 拆回各自的 item；整包解析失败或缺某人时该部分回退逐份调用。
+    SPLIT_PROFILE 时为两次批量请求：先抽没有缓存的档案，再统一打分。返回回退份数"""
+    ids = [f"c{k+1}" for k in range(len(items))]
+    if SPLIT_PROFILE:
+        profs = {cid: cached_profile(it) for cid, it in zip(ids, items)}
+        for p in profs.values():
+            inc("profile_cache_total", result="hit" if p is not None else "miss")
+        todo = [(cid, it) for cid, it in zip(ids, items) if profs[cid] is None]
+        if todo:
+            got = llm_json_batch(build_profile_messages([(cid, it["prompt_text"]) for cid, it in todo]), len(todo),
+                                 need_score=False)
+            for cid, it in todo:
+                if got.get(cid) and CACHE:
+                    CACHE.set(profile_key(it["prompt_text"]), got[cid])
+                profs[cid] = got.get(cid)
+        ready = [(cid, profs[cid]) for cid in ids if profs[cid]]
+        scores = llm_json_batch(build_score_messages(job, ready), len(ready)) if ready else {}
+        by_id = {cid: {**profs[cid], **{k: scores[cid][k] for k in ("score", "grade", "fit_summary", "risks")
+                                        if k in scores[cid]}}
+                 for cid, _ in ready if cid in scores}
+    else:
+        msgs = build_batch_messages(job["role"],job["track"],job["note"],job["limits"],job["must"],job["nice"],
+                                    [(cid, it["prompt_text"]) for cid, it in zip(ids, items)])
+        by_id = llm_json_batch(msgs, len(items))
+    fallback = 0
+    for cid, it in zip(ids, items):
+        d = by_id.get(cid)
+        if d:
+            it["data"] = d
+            if CACHE:
+                CACHE.set(it["key"], d)
+        else:
+            fallback += 1
+            inc("llm_retries_total", kind="batch_fallback")
+            score_resume(it)
+    return fallback
+
+def finalize_resume(item:Dict[str,Any]) -> Dict[str,Any]:
+    """兜底字段、分数等级与去重签名"""
+    data, email = item["data"], item["email"]
     # 兜底字段
     data["email"] = data.get("email") or email or ""
-    data["name"]  = (data.get("name") or "").strip() or os.path.splitext(os.path.basename(path))[0]
+    data["name"]  = (data.get("name") or "").strip() or os.path.splitext(item["name"])[0]
     data["current_company"] = data.get("current_company") or ""
     data["current_title"]   = data.get("current_title") or ""
     data["remark"] = data.get("remark") or ""
@@ -394,144 +1844,681 @@ def process_resume(path:str, role:str, track:str, note:str, limits:str, must:str
 
     # 去重签名
     data["_sig"] = (data["name"].strip().lower(), data["current_company"].strip().lower())
+    data["_cache"] = "hit" if item["cached"] else "miss"
+    data["local_score"] = item.get("local_score", "")
     return data
 
-def write_excel(rows: List[Dict[str,Any]], xlsx_path:str):
-    import openpyxl
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Candidates"
+def unevaluated_row(item:Dict[str,Any]) -> Dict[str,Any]:
+    """本地预排未入选、未送 LLM 的候选人：文件名、邮箱与本地分；以前抽取过档案的带上档案字段"""
+    row = {"name":os.path.splitext(item["name"])[0], "email":item.get("email",""),
+           "current_company":"", "current_title":"", "remark":"", "fit_summary":"", "risks":"",
+           "age_estimate":"不详", "score":"", "grade":"未评估", "local_score":item.get("local_score", "")}
+    prof = cached_profile(item)
+    if prof:
+        row.update({k: prof[k] for k in ("name", "current_company", "current_title", "location", "tags", "remark")
+                    if prof.get(k)})
+        row["email"] = row["email"] or prof.get("email") or ""
+        row["age_estimate"] = prof.get("age_estimate") or estimate_age_from_edu(prof.get("education"))
+    return row
 
-    headers = [
-        "候选人名字","目前公司","目前职位","匹配等级","分数",
-        "Email","年龄预估","目前所在地","契合摘要","风险点","标签","Remarks(时间线概述)"
-    ]
-    ws.append(headers)
+EXPORT_COLS = [   # (表头, 取值)：Excel / CSV 共用，固定13列
+    ("候选人名字", lambda r: r.get("name","")),
+    ("目前公司", lambda r: r.get("current_company","")),
+    ("目前职位", lambda r: r.get("current_title","")),
+    ("匹配等级", lambda r: r.get("grade","")),
+    ("分数", lambda r: r.get("score","")),
+    ("Email", lambda r: r.get("email","")),
+    ("年龄预估", lambda r: r.get("age_estimate","")),
+    ("目前所在地", lambda r: r.get("location","")),
+    ("契合摘要", lambda r: r.get("fit_summary","")),
+    ("风险点", lambda r: r.get("risks","")),
+    ("标签", lambda r: ", ".join(r.get("tags",[]) or [])),
+    ("Remarks(时间线概述)", lambda r: r.get("remark","")),
+    ("本地分", lambda r: r.get("local_score","")),
+]
+GRADES = ["A+", "A", "B", "C", "未评估"]
 
-    for r in rows:
-        ws.append([
-            r.get("name",""),
-            r.get("current_company",""),
-            r.get("current_title",""),
-            r.get("grade",""),
-            r.get("score",""),
-            r.get("email",""),
-            r.get("age_estimate",""),
-            r.get("location",""),
-            r.get("fit_summary",""),
-            r.get("risks",""),
-            ", ".join(r.get("tags",[]) or []),
-            r.get("remark",""),
-        ])
-
-    for col in ws.columns:
-        ws.column_dimensions[col[0].column_letter].width = 18
+def export_row(r:Dict[str,Any]) -> List[Any]:
+    return [get(r) for _, get in EXPORT_COLS]
+
+def write_excel(rows:Iterable[Dict[str,Any]], out):
+    """write-only 模式逐行写出，内存不随行数增长；匹配等级列带下拉校验。out 为路径或文件对象"""
+    import openpyxl
+    from openpyxl.worksheet.datavalidation import DataValidation
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Candidates")
+    for i in range(len(EXPORT_COLS)):
+        ws.column_dimensions[openpyxl.utils.get_column_letter(i + 1)].width = 18
     ws.column_dimensions['I'].width = 28
     ws.column_dimensions['L'].width = 48
-    wb.save(xlsx_path)
+    ws.freeze_panes = "A2"
+    dv = DataValidation(type="list", formula1='"%s"' % ",".join(GRADES), allow_blank=True)
+    dv.add("D2:D1048576")
+    ws.data_validations.append(dv)
+    ws.append([h for h, _ in EXPORT_COLS])
+    for r in rows:
+        ws.append(export_row(r))
+    wb.save(out)
+
+class RowSink:
+    """边打分边追加的 CSV / JSONL 结果文件（data/<任务>/<任务>.csv|.jsonl），运行中即可下载"""
+    def __init__(self, work_dir:str, rid:str):
+        self.csv_path = os.path.join(work_dir, f"{rid}.csv")
+        self.jsonl_path = os.path.join(work_dir, f"{rid}.jsonl")
+        self.lock = threading.Lock()
+
+    def reset(self, rows:Iterable[Dict[str,Any]]):
+        """重写两份文件（续跑开始时写入已有结果，结束时按排名重写）"""
+        with self.lock:
+            for path in (self.csv_path, self.jsonl_path):
+                with open(path + ".tmp", "w", encoding="utf-8-sig" if path.endswith(".csv") else "utf-8", newline="") as f:
+                    if path.endswith(".csv"):
+                        w = csv.writer(f)
+                        w.writerow([h for h, _ in EXPORT_COLS])
+                        w.writerows(export_row(r) for r in rows)
+                    else:
+                        f.writelines(self._line(r) for r in rows)
+                os.replace(path + ".tmp", path)
+
+    def append(self, r:Dict[str,Any]):
+        with self.lock:
+            with open(self.csv_path, "a", encoding="utf-8", newline="") as f:
+                csv.writer(f).writerow(export_row(r))
+            with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(self._line(r))
+
+    @staticmethod
+    def _line(r:Dict[str,Any]) -> str:
+        return json.dumps({k: v for k, v in r.items() if not k.startswith("_")}, ensure_ascii=False) + "\n"
+
+def partial_rows(rid:str) -> List[Dict[str,Any]]:
+    """从 JSONL 结果文件读出当前已出分的候选人并排序（任意 worker 都能读）"""
+    rows = []
+    try:
+        with open(os.path.join(run_dir(rid), f"{rid}.jsonl"), encoding="utf-8") as f:
+            for ln in f:
+                try:
+                    rows.append(json.loads(ln))
+                except ValueError:
+                    pass   # 正在写的最后一行
+    except OSError:
+        pass
+    rows.sort(key=rank_key)
+    return rows
+
+# ---------- 任务执行与断点续跑 ----------
+def perf_summary(m:Metrics, wall:float, man:Dict[str,Any]) -> List[str]:
+    """任务结束时的性能汇总（写在实时日志末尾）"""
+    ms = lambda h: f"p50 {h['p50']*1000:.0f}ms / p95 {h['p95']*1000:.0f}ms"
+    up_mb = sum(u.get("bytes", 0) for u in man.get("uploads", [])) / 2**20
+    lines = [f"⏱ 性能汇总：总耗时 {wall:.1f}s；上传 {up_mb:.1f}MB 用时 {man.get('upload_s', 0):.1f}s"]
+    uz = m.hist("unzip_seconds")
+    if uz["count"]:
+        lines.append(f"  解压：{uz['count']} 个成员 {m.total('unzip_bytes_total')/2**20:.1f}MB，共 {uz['sum']:.2f}s")
+    for ext in m.hist_labels("extract_seconds", "ext"):
+        h, c = m.hist("extract_seconds", ext=ext, source="parse"), m.hist("extract_seconds", ext=ext, source="cache")
+        lines.append(f"  抽取 {ext}：解析 {h['count']} 个 共 {h['sum']:.2f}s（{ms(h)}），缓存命中 {c['count']} 个"
+                     + (f"，空文本 {m.total('extract_empty_total', ext=ext):g} 个" if m.total("extract_empty_total", ext=ext) else ""))
+    lat = m.hist("llm_latency_seconds")
+    if lat["count"]:
+        errs = {k: v for k, v in m.by_label("llm_requests_total", "outcome").items() if k != "ok"}
+        lines.append(f"  LLM：{lat['count']} 次请求，{ms(lat)}，最慢 {lat['max']:.1f}s；"
+                     f"失败 {sum(errs.values()):g}" + (f"（{'，'.join(f'{k} {v:g}' for k, v in errs.items())}）" if errs else ""))
+        parsed = m.by_label("json_parse_total", "result")
+        lines.append(f"  JSON：直接解析 {parsed.get('ok', 0):g}，本地修复 {parsed.get('repaired_local', 0):g}，"
+                     f"二次调用修复 {parsed.get('repaired_llm', 0):g}，失败 {parsed.get('failed', 0):g}；"
+                     f"重试 修复调用 {m.total('llm_retries_total', kind='repair'):g} / 批量回退 {m.total('llm_retries_total', kind='batch_fallback'):g}")
+        lines.append(f"  容错：退避重试 {m.total('llm_retries_total', kind='retry'):g} 次，"
+                     f"对冲 {m.total('llm_retries_total', kind='hedge'):g} 次（补发先到 {m.total('llm_retries_total', kind='hedge_won'):g}），"
+                     f"熔断 {m.total('breaker_transitions_total', to='open'):g} 次，超截止时间 {m.total('llm_requests_total', outcome='deadline'):g} 次")
+        lines.append(f"  tokens（usage）：提示 {m.total('llm_prompt_tokens_total'):g} / 生成 {m.total('llm_completion_tokens_total'):g}")
+    prof = m.by_label("profile_cache_total", "result")
+    if prof:
+        lines.append(f"  档案：缓存命中 {prof.get('hit', 0):g}，新抽取 {prof.get('miss', 0):g}"
+                     + ("（命中的只做岗位打分）" if prof.get("hit") else ""))
+    skips = m.by_label("dedupe_skips_total", "kind")
+    if skips:
+        lines.append("  去重跳过：" + "，".join(f"{k} {v:g}" for k, v in sorted(skips.items())))
+    lines.append("  各级耗时：" + "；".join(f"{st} {m.hist('stage_seconds', stage=st)['sum']:.1f}s"
+                                       for st in m.hist_labels("stage_seconds", "stage")))
+    lines.append(f"  导出：{m.hist('export_seconds')['sum']:.2f}s")
+    return lines
+
+def write_manifest(rid:str, manifest:Dict[str,Any]):
+    """任务输入清单：岗位参数、运行选项与上传文件列表，续跑时据此重建任务"""
+    path = os.path.join(DATA_DIR, rid, "manifest.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def load_manifest(rid:str) -> Optional[Dict[str,Any]]:
+    try:
+        with open(os.path.join(DATA_DIR, rid, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class RunJournal:
+    """追加式结果日志（每任务一个 journal.jsonl）：每处理完一份简历写一行，进程重启后只需补跑缺的文件"""
+    def __init__(self, path:str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, rec:Dict[str,Any]):
+        line = json.dumps(rec, ensure_ascii=False, default=list) + "\n"
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def load(self) -> List[Dict[str,Any]]:
+        recs = []
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        recs.append(json.loads(line))
+                    except ValueError:
+                        pass   # 崩溃时写了半行
+        except OSError:
+            pass
+        return recs
+
+def start_job(rid:str, resume:bool=False) -> bool:
+    """在本进程启动任务；已有存活进程在执行（心跳新鲜）时返回 False"""
+    if not STORE.claim(rid, OWNER, RUN_STALE_S):
+        return False
+    threading.Thread(target=run_job, args=(rid, resume), daemon=True).start()
+    return True
+
+def run_job(rid:str, resume:bool=False):
+    man = load_manifest(rid) or {}
+    job = man.get("job") or {}
+    role, track, note, limits, must, nice = (job.get(k, "") for k in ("role","track","note","limits","must","nice"))
+    top_n, min_local = man.get("top_n", 0), man.get("min_local", 0)
+    local_only = man.get("local_only", False)
+    work_dir = run_dir(rid)
+    STORE.update(rid, role=role, track=track, cancel=False)
+    SCHED.register(rid, man.get("priority", "normal"))
+    alive = threading.Event()
+    def beat():   # 心跳：其他 worker 据此判断本任务是否仍在执行；/cancel 落在别的 worker 上时经状态库转达
+        last = time.time()
+        while not alive.wait(1.0):
+            if (STORE.get(rid) or {}).get("cancel"):
+                SCHED.cancel(rid)
+            if time.time() - last >= RUN_STALE_S / 4:
+                STORE.heartbeat(rid)
+                last = time.time()
+    threading.Thread(target=beat, daemon=True).start()
+    up_dir   = os.path.join(work_dir,"uploads")
+    journal  = RunJournal(os.path.join(work_dir, "journal.jsonl"))
+    out      = RowSink(work_dir, rid)
+    rm = Metrics()
+    RUN_METRICS.set(rm)
+    RUN_ID.set(rid)
+    t_start = time.time()
+    RUN_DEADLINE.set(t_start + RUN_DEADLINE_MIN * 60 if RUN_DEADLINE_MIN > 0 else 0.0)
+    try:
+        # 续跑：日志里已完成的文件直接复用（失败的重跑）
+        prior = {r["sha"]: r for r in journal.load() if r.get("kind") != "fail"} if resume else {}
+        put(rid, f"▶ 断点续跑：已完成 {len(prior)} 个，补跑其余…" if resume else "▶ 开始处理…")
+        uploads = [os.path.join(up_dir, u["file"]) for u in man.get("uploads", [])]
+        total = sum(count_upload(p) for p in uploads)
+        put(rid, f"解析 待办 {total} 个文件")
+        ingest = {"dups":0, "skipped":0}
+
+        def source():
+            seen = set()
+            for p in uploads:
+                for it in iter_upload(p, seen, ingest):
+                    if SCHED.cancelled(rid):   # 取消：不再读后面的文件
+                        return
+                    if it["sha"] not in prior:
+                        it["t_in"] = time.time()
+                        yield it
+
+        results, seen = [], set()
+        for r in prior.values():
+            if r["kind"] == "row":
+                sig = tuple(r["row"].get("_sig") or ())
+                if sig not in seen:
+                    seen.add(sig)
+                    results.append(dict(r["row"], _sig=sig))
+            elif r["kind"] == "skip":
+                results.append(r["row"])
+        out.reset(results)
+        # top-N 是整个任务的名额：续跑时扣掉已评估的
+        top_left = max(0, top_n - sum(r["kind"] == "row" for r in prior.values())) if top_n else 0
+        cnt = {"i":len(prior), "hit":0, "miss":0, "window":LIMITER.window, "text_hit":0, "near":0, "skip":0,
+               "batches":0, "batched":0, "fallback":0, "tok_in":0, "tok_out":0, "fast_only":0, "escalated":0,
+               "cancelled":0, "failed":0}
+        parse_stats: Dict[str,List[float]] = {}   # ext -> [文件数, 累计秒]
+        put(rid, f"并发窗口 {cnt['window']}（上限 {MAX_CONCURRENCY}，本进程所有任务共享）；优先级 {man.get('priority', 'normal')}")
+
+        def parse(it):
+            it.update(parse_document(it.pop("raw"), it["ext"], it["src"], it["sha"]))
+            yield it
+        near = NearDupIndex(DEDUP_THRESHOLD) if DEDUP_THRESHOLD > 0 else None
+        for r in prior.values():   # 续跑时已完成的文件仍参与近似去重
+            if near and r.get("mh"):
+                near.match_or_add(tuple(r["mh"]), r["name"])
+        ranker = KeywordRanker(job)
+        pending: List[Dict[str,Any]] = []   # top-N 模式下等全部解析完再排序
+
+        def prep(it):
+            it["mh"] = near.signature(it["text"]) if near else None
+            hit = near.match_or_add(it["mh"], it["name"]) if near else None
+            if hit:
+                it["dup_of"] = hit
+                yield it
+                return
+            it["local_score"] = ranker.score(it["text"])
+            yield prepare_resume(it, job)
+        def rank(it):
+            if it.get("dup_of"):
+                yield it
+            elif local_only or min_local and it["local_score"] < min_local:
+                it["skip_llm"] = True
+                yield it
+            elif top_n:
+                pending.append(it)
+            else:
+                yield it
+        def rank_flush():
+            pending.sort(key=lambda x: x["local_score"], reverse=True)
+            for k, it in enumerate(pending):
+                it["skip_llm"] = k >= top_left
+                yield it
+        def fast(it):
+            # 两档模式：快速档先出分，不需升级的直接定稿；快速档失败的交完整档
+            if FAST and not (it.get("dup_of") or it.get("skip_llm") or it["cached"]):
+                d = fast_score(it, job)
+                if d and not needs_escalation(d["score"]):
+                    it["data"], it["tier"] = d, "fast"
+                    inc("cascade_total", result="fast_only")
+                else:
+                    it["escalated"] = bool(d)
+                    inc("cascade_total", result="escalated" if d else "fast_failed")
+            yield it
+        batch: List[Dict[str,Any]] = []
+        def pack(it):
+            # 只有需要真正调用 LLM 的件才打包；凑满条数或 token 预算就发出一包
+            if BATCH_SIZE <= 1 or it.get("dup_of") or it.get("skip_llm") or it["cached"] or it.get("tier") == "fast":
+                yield it
+                return
+            if batch and (len(batch) >= BATCH_SIZE or
+                          sum(estimate_tokens(b["prompt_text"]) for b in batch) + estimate_tokens(it["prompt_text"]) > BATCH_TOKENS):
+                yield {"batch":batch[:]}
+                batch.clear()
+            batch.append(it)
+        def pack_flush():
+            if batch:
+                yield {"batch":batch[:]}
+        def llm(it):
+            if "batch" in it:
+                cnt["batches"] += 1
+                cnt["batched"] += len(it["batch"])
+                cnt["fallback"] += score_batch(it["batch"], job)
+                yield from it["batch"]
+            else:
+                yield it if it.get("dup_of") or it.get("skip_llm") or it.get("tier") == "fast" else score_resume(it)
+        def post(it):
+            if it.get("skip_llm"):
+                it["row"] = unevaluated_row(it)
+            elif not it.get("dup_of"):
+                it["row"] = finalize_resume(it)
+            yield it
+
+        def sink(it):
+            cnt["i"] += 1
+            observe("resume_seconds", time.time() - it["t_in"])   # 单份简历从读出到出结果（含排队）
+            i, n = cnt["i"], total - ingest["dups"] - ingest["skipped"]
+            STORE.update(rid, done_n=i, total_n=n)
+            if "ext" in it:
+                ps = parse_stats.setdefault(it["ext"], [0, 0.0])
+                ps[0] += 1; ps[1] += it["parse_s"]
+                cnt["text_hit"] += it["text_cached"]
+            if LIMITER.window != cnt["window"]:
+                cnt["window"] = LIMITER.window
+                put(rid, f"并发窗口 → {cnt['window']}")
+            if it.get("_error"):
+                journal.append({"sha":it["sha"], "kind":"fail", "name":it["name"]})
+                cnt["failed"] += 1
+                put(rid, f"[{i}/{n}] {it['name']} 处理失败（{it['_error']}），续跑时重试")
+                return
+            if it.get("dup_of"):
+                journal.append({"sha":it["sha"], "kind":"near", "name":it["name"], "dup_of":it["dup_of"]})
+                cnt["near"] += 1
+                inc("dedupe_skips_total", kind="near")
+                put(rid, f"[{i}/{n}] [近似重复] {it['name']} ≈ {it['dup_of'][0]}（相似度 {it['dup_of'][1]:.2f}），未调用 LLM")
+                return
+            d = it["row"]
+            if it.get("skip_llm"):
+                journal.append({"sha":it["sha"], "kind":"skip", "name":it["name"], "row":d, "mh":it.get("mh")})
+                cnt["skip"] += 1
+                results.append(d)
+                out.append(d)
+                put(rid, f"[{i}/{n}] {d['name']} → 未评估（本地分 {d['local_score']}）")
+                return
+            # LLM 没给出结果的记为失败，续跑时重试
+            journal.append({"sha":it["sha"], "kind":"fail" if it.get("llm_failed") else "row", "name":it["name"],
+                            "row":d, "mh":it.get("mh")})
+            if it.get("llm_failed") and SCHED.cancelled(rid):   # 取消时排队中的直接退出，不逐条刷屏
+                cnt["cancelled"] += 1
+                return
+            cnt["failed"] += bool(it.get("llm_failed"))
+            cnt["hit" if d.get("_cache") == "hit" else "miss"] += 1
+            if it.get("tier") == "fast" or it.get("escalated"):
+                cnt["fast_only" if it.get("tier") == "fast" else "escalated"] += 1
+            inc("llm_cache_total", result=d.get("_cache") or "miss")
+            cnt["tok_in"] += it["tokens_in"]; cnt["tok_out"] += it["tokens_out"]
+            sig = d.get("_sig")
+            if sig and sig in seen:
+                inc("dedupe_skips_total", kind="same_person")
+                put(rid, f"[跳过重复] {d.get('name','')}")
+            else:
+                seen.add(sig)
+                results.append(d)
+                out.append(d)
+                tier = "（快速档）" if it.get("tier") == "fast" else "（快速档→完整档）" if it.get("escalated") else ""
+                put(rid, f"[{i}/{n}] {d.get('name','?')} → {d.get('grade','')} / {d.get('score','')}{tier}"
+                         f"（tokens {it['tokens_in']}→{it['tokens_out']}）" + ("（LLM 无结果，续跑时重试）" if it.get("llm_failed") else ""))
+
+        # 解析（CPU）与 LLM（I/O）分级并行：LLM 级线程按并发上限开，实际在途请求由 LIMITER 控制
+        run_pipeline(source(),
+                     [Stage("parse", parse, max(PARSE_WORKERS, PARSE_PROCS)),
+                      Stage("prep", prep),
+                      Stage("rank", rank, flush=rank_flush),
+                      Stage("fast", fast, FAST_MAX_CONCURRENCY if FAST else 1),
+                      Stage("pack", pack, flush=pack_flush),
+                      Stage("llm", llm, MAX_CONCURRENCY),
+                      Stage("post", post)],
+                     sink, maxsize=MAX_CONCURRENCY*2)
+        hits, misses = cnt["hit"], cnt["miss"]
+        cancelled = SCHED.cancelled(rid)
+        if cancelled:
+            put(rid, f"⏹ 已取消：已出结果 {len(results)} 份，排队中撤回 {cnt['cancelled']} 份，其余文件未读取；可点“继续（断点续跑）”补完")
+
+        if ingest["dups"] or ingest["skipped"]:
+            put(rid, f"ZIP 内容重复跳过 {ingest['dups']} 个，超限/损坏跳过 {ingest['skipped']} 个")
+        put(rid, "解析耗时：" + "；".join(f"{ext} {n} 个 共 {t:.1f}s（均 {t/n:.2f}s）"
+                                    for ext,(n,t) in sorted(parse_stats.items(), key=lambda kv: -kv[1][1]))
+            + f"；文本缓存命中 {cnt['text_hit']}")
+        put(rid, f"缓存：命中 {hits} / 未命中 {misses}")
+        if near:
+            put(rid, f"近似去重（阈值 {DEDUP_THRESHOLD}）：合并 {cnt['near']} 份，节省 LLM 调用 {cnt['near']} 次")
+        if top_n or min_local:
+            put(rid, f"本地预排（前 {top_n or '全部'} 名，阈值 {min_local}）：送 LLM {hits + misses} 份，未评估 {cnt['skip']} 份")
+        if cnt["tok_in"]:
+            put(rid, f"简历压缩：{cnt['tok_in']} → {cnt['tok_out']} tokens（-{100 - 100*cnt['tok_out']//cnt['tok_in']}%，预算 {RESUME_TOKEN_BUDGET}/份）")
+        if FAST:
+            put(rid, f"分级打分：快速档定稿 {cnt['fast_only']} 份，升级完整档 {cnt['escalated']} 份，"
+                     f"完整档共处理 {hits + misses - cnt['fast_only']} 份（含缓存命中与快速档失败）")
+        if cnt["batches"]:
+            put(rid, f"批量打分：{cnt['batches']} 次请求覆盖 {cnt['batched']} 份简历，回退逐份 {cnt['fallback']} 份")
+        results.sort(key=rank_key)
+        STORE.set_results(rid, results)
+
+        xlsx = os.path.join(work_dir, f"{rid}.xlsx")
+        t0 = time.time()
+        write_excel(results, xlsx)
+        out.reset(results)
+        observe("export_seconds", time.time() - t0)
+        put(rid, "导出 Excel / CSV / JSONL 完成")
+        observe("run_seconds", time.time() - t_start)
+        for line in perf_summary(rm, time.time() - t_start, man):
+            put(rid, line)
+        put(rid, "__READY_EXCEL__")
+
+        if cancelled:
+            STORE.update(rid, status="cancelled", finished=time.time())
+        elif cnt["failed"]:   # 结果日志里有失败记录：留给“继续（断点续跑）”重试
+            put(rid, f"⚠ 完成，共 {len(results)} 人；其中 {cnt['failed']} 份解析失败或 LLM 无结果，可点“继续（断点续跑）”重试")
+            STORE.update(rid, status="partial", finished=time.time())
+        else:
+            put(rid, f"✅ 完成，共 {len(results)} 人。")
+            STORE.update(rid, status="done", finished=time.time())   # 先写完消息再改状态，/stream 据此判断日志已完整
+    except Exception as e:
+        logging.exception("runner fatal")
+        put(rid, f"❌ 失败：{e}")
+        STORE.update(rid, status="failed", finished=time.time())
+    finally:
+        alive.set()
+        SCHED.unregister(rid)
+
+
+# ---------- 生命周期与清理 ----------
+USAGE: Dict[str,Any] = {"last_gc":0.0, "removed_runs":0, "removed_uploads":0, "evicted_mem_runs":0}
+
+def dir_bytes(path:str) -> int:
+    total = 0
+    for root, _, fs in os.walk(path):
+        for f in fs:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for ln in f:
+                if ln.startswith("VmRSS:"):
+                    return int(ln.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def gc_once():
+    """按保留策略清理 DATA_DIR 与任务状态：
+    已完成任务的上传原件超过 UPLOAD_RETENTION_HOURS 删除；任何结束/中断的任务超过 ARTIFACT_RETENTION_DAYS 整体删除；
+    正在执行（心跳新鲜）或刚创建的任务不动"""
+    now = time.time()
+    runs = {r["rid"]: r for r in STORE.list_runs()}
+    for name in os.listdir(DATA_DIR):
+        d = os.path.join(DATA_DIR, name)
+        if not os.path.isdir(d) or not RID_RE.match(name):
+            continue
+        run = runs.pop(name, None) or {}
+        status = run.get("status")
+        if status == "running" and now - run.get("heartbeat", 0) < RUN_STALE_S:
+            continue
+        age = now - (run.get("finished") or run.get("created") or os.path.getmtime(d))
+        if status == "new" and age < 3600:   # 还在上传
+            continue
+        if age > ARTIFACT_RETENTION_D * 86400:
+            shutil.rmtree(d, ignore_errors=True)
+            STORE.delete(name)
+            USAGE["removed_runs"] += 1
+        elif status == "done" and age > UPLOAD_RETENTION_H * 3600:
+            for sub in ("uploads", "unz"):
+                if os.path.isdir(os.path.join(d, sub)):
+                    shutil.rmtree(os.path.join(d, sub), ignore_errors=True)
+                    USAGE["removed_uploads"] += 1
+    for rid, run in runs.items():   # 目录已不在的残留状态
+        if now - (run.get("finished") or run.get("created") or run["heartbeat"]) > ARTIFACT_RETENTION_D * 86400:
+            STORE.delete(rid)
+    USAGE["evicted_mem_runs"] += STORE.evict_lru(MAX_MEM_RUNS)
+    for c in (CACHE, TEXT_CACHE):
+        if c:
+            c.evict()
+    USAGE["last_gc"] = now
+
+def usage_snapshot() -> Dict[str,Any]:
+    runs = STORE.list_runs()
+    by_status: Dict[str,int] = {}
+    for r in runs:
+        by_status[r["status"]] = by_status.get(r["status"], 0) + 1
+    uploads = sum(dir_bytes(os.path.join(DATA_DIR, n, "uploads")) for n in os.listdir(DATA_DIR)
+                  if os.path.isdir(os.path.join(DATA_DIR, n, "uploads")))
+    total = dir_bytes(DATA_DIR)
+    queued = LIMITER.queued()
+    sched = {rid: {"weight":w, "queued":queued.get(rid, 0)} for rid, w in SCHED.active().items()}
+    return {"rss_mb":round(rss_bytes()/2**20, 1), "data_dir_mb":round(total/2**20, 1),
+            "uploads_mb":round(uploads/2**20, 1), "runs":by_status, "scheduler":sched, **USAGE}
+
+def gc_loop():
+    while True:
+        try:
+            gc_once()
+        except Exception:
+            logging.exception("gc failed")
+        time.sleep(GC_INTERVAL_S)
+
+if multiprocessing.current_process().name == "MainProcess":   # 解析子进程不跑清理
+    threading.Thread(target=gc_loop, daemon=True, name="gc").start()
 
 # ---------- 路由 ----------
+@app.errorhandler(413)
+def too_large(e):
+    return (f"总大小超过限制 {MAX_UPLOAD_MB}MB", 413)
+
 @app.route("/", methods=["GET"])
 def index():
-    return render_template_string(INDEX_HTML)
+    return render_template_string(INDEX_HTML, src=None, job={})
+
+def job_form() -> Dict[str,Any]:
+    """表单里的岗位条件；不合法时抛 ValueError（消息可直接返回给用户）"""
+    job = {k: (request.form.get(k) or "").strip() for k in ("role","track","note","limits","must","nice")}
+    if not job["role"]:
+        raise ValueError("职位名称必填")
+    try:
+        top_n     = int(request.form.get("llm_top_n") or 0)
+        min_local = float(request.form.get("llm_min_local") or 0)
+    except ValueError:
+        raise ValueError("“前 N 名”与“本地分阈值”须为数字")
+    priority = request.form.get("priority") or "normal"
+    if priority not in PRIORITY_WEIGHTS:
+        raise ValueError("优先级须为 high / normal / low")
+    return {"job":job, "top_n":top_n, "min_local":min_local, "priority":priority}
+
+def new_run(role:str, track:str) -> str:
+    rid = f"{slugify(role)[:60]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"   # 截断，保证 rid 总能通过 RID_RE
+    if get_run(rid) or os.path.exists(run_dir(rid)):
+        rid += "_" + os.urandom(2).hex()
+    STORE.create(rid, {"name":rid, "role":role, "track":track, "created":time.time()})
+    return rid
 
 @app.route("/process", methods=["POST"])
 def process():
-    role   = (request.form.get("role") or "").strip()
-    track  = (request.form.get("track") or "").strip()
-    note   = (request.form.get("note") or "").strip()
-    limits = (request.form.get("limits") or "").strip()
-    must   = (request.form.get("must") or "").strip()
-    nice   = (request.form.get("nice") or "").strip()
-    if not role:
-        return ("职位名称必填", 400)
-
-    rid = f"{slugify(role)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    run = ensure_run(rid)
-    run["role"], run["track"], run["name"] = role, track, rid
-
-    work_dir = run["dir"]
+    try:
+        form = job_form()
+    except ValueError as e:
+        return (str(e), 400)
+    rid = new_run(form["job"]["role"], form["job"]["track"])
+
+    work_dir = run_dir(rid)
     up_dir   = os.path.join(work_dir,"uploads")
     os.makedirs(up_dir, exist_ok=True)
 
     files = request.files.getlist("files")
     if not files:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        STORE.delete(rid)
         return ("请上传文件", 400)
 
-    sz_total = 0
+    budget = MAX_UPLOAD_MB*1024*1024
+    taken, hashes, dup_uploads, manifest = set(), set(), 0, []
+    t0 = time.time()
     for f in files:
-        b = f.read()
-        sz_total += len(b)
-        if sz_total > MAX_UPLOAD_MB*1024*1024:
+        path = os.path.join(up_dir, safe_filename(f.filename, taken))
+        n, sha = save_upload(f, path, budget)
+        if n < 0:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            STORE.delete(rid)
             return (f"总大小超过限制 {MAX_UPLOAD_MB}MB", 400)
-        with open(os.path.join(up_dir, f.filename), "wb") as o:
-            o.write(b)
-
-    def runner():
-        try:
-            put(rid, "▶ 开始处理…")
-            todo = []
-            for fn in os.listdir(up_dir):
-                todo += handle_zip_or_file(os.path.join(up_dir,fn), os.path.join(work_dir,"unz"))
-            todo = [p for p in todo if os.path.splitext(p)[1].lower() in (".pdf",".html",".htm",".txt",".docx")]
-            todo = sorted(set(todo))
-            put(rid, f"解析 待办 {len(todo)} 个文件")
-
-            results, seen = [], set()
-            with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex:
-                futs = [ex.submit(process_resume, p, role, track, note, limits, must, nice) for p in todo]
-                for i,fut in enumerate(as_completed(futs), start=1):
-                    try:
-                        d = fut.result()
-                    except Exception as e:
-                        d = {}
-                        logging.warning("worker error: %s", e)
-                    if d:
-                        sig = d.get("_sig")
-                        if sig and sig in seen:
-                            put(rid, f"[跳过重复] {d.get('name','')}")
-                        else:
-                            seen.add(sig)
-                            results.append(d)
-                            put(rid, f"[{i}/{len(todo)}] {d.get('name','?')} → {d.get('grade','')} / {d.get('score','')}")
-                    else:
-                        put(rid, f"[{i}/{len(todo)}] 解析失败")
-
-            results.sort(key=lambda x: x.get("score",0), reverse=True)
-            run["summary"] = results
-
-            xlsx = os.path.join(work_dir, f"{rid}.xlsx")
-            write_excel(results, xlsx)
-            put(rid, "导出 Excel 完成")
-            put(rid, "__READY_EXCEL__")
+        budget -= n
+        inc("upload_bytes_total", n)
+        if sha in hashes:
+            os.remove(path)
+            dup_uploads += 1
+        else:
+            manifest.append({"file":os.path.basename(path), "bytes":n, "sha":sha})
+        hashes.add(sha)
+    upload_s = time.time() - t0
+    observe("upload_seconds", upload_s)
+    if dup_uploads:
+        put(rid, f"上传文件内容重复 {dup_uploads} 个，已忽略")
 
-            run["done"] = True
-            put(rid, f"✅ 完成，共 {len(results)} 人。")
-        except Exception as e:
-            logging.exception("runner fatal")
-            put(rid, f"❌ 失败：{e}")
-
-    from threading import Thread
-    Thread(target=runner, daemon=True).start()
+    write_manifest(rid, {"rid":rid, "created":time.time(), "uploads":manifest, "upload_s":upload_s, **form})
+    start_job(rid)
     return redirect(url_for("events", rid=rid))
 
+@app.route("/rescore/<rid>", methods=["GET", "POST"])
+def rescore(rid):
+    """换岗位条件重评：新建任务，复用原任务的上传文件。解析与档案抽取都走缓存，只重做岗位打分；
+    勾选“仅本地”时完全不调 LLM"""
+    man = load_manifest(rid) if RID_RE.match(rid) else None
+    if not man:
+        return ("任务不存在或缺少输入清单", 404)
+    src_dir = os.path.join(run_dir(rid), "uploads")
+    if not all(os.path.exists(os.path.join(src_dir, u["file"])) for u in man.get("uploads", [])):
+        return ("原任务的上传文件已清理，请重新上传", 410)
+    if request.method == "GET":
+        return render_template_string(INDEX_HTML, src=rid, job=man.get("job") or {},
+                                      top_n=man.get("top_n"), min_local=man.get("min_local"), priority=man.get("priority"))
+    try:
+        form = job_form()
+    except ValueError as e:
+        return (str(e), 400)
+    new = new_run(form["job"]["role"], form["job"]["track"])
+    up_dir = os.path.join(run_dir(new), "uploads")
+    os.makedirs(up_dir, exist_ok=True)
+    for u in man.get("uploads", []):
+        src, dst = os.path.join(src_dir, u["file"]), os.path.join(up_dir, u["file"])
+        try:
+            os.link(src, dst)   # 同一文件系统上硬链接，不占额外空间；原任务被清理也不影响
+        except OSError:
+            shutil.copyfile(src, dst)
+    write_manifest(new, {"rid":new, "created":time.time(), "uploads":man.get("uploads", []), "upload_s":0.0,
+                         "rescore_of":rid, "local_only":request.form.get("local_only") == "1", **form})
+    put(new, f"重新评分：复用任务 {rid} 的 {len(man.get('uploads', []))} 个上传文件")
+    start_job(new)
+    return redirect(url_for("events", rid=new))
+
 @app.route("/events/<rid>")
 def events(rid):
-    run = ensure_run(rid)
-    return render_template_string(EVENTS_HTML, rid=rid, name=run.get("name", rid))
+    run = get_run(rid)
+    if not run:
+        return ("任务不存在", 404)
+    return render_template_string(EVENTS_HTML, rid=rid, name=run.get("name", rid), top_k=PARTIAL_TOP_K)
+
+def sse_event(seq:int, msg:str) -> str:
+    return f"id: {seq}\n" + "".join(f"data: {ln}\n" for ln in (msg.split("\n") or [""])) + "\n"
 
 @app.route("/stream/<rid>")
 def stream(rid):
-    run = ensure_run(rid)
-    q: Queue = run["q"]
+    """SSE：从共享事件日志按序号推送。每个连接各自读日志，多个标签页互不抢消息；
+    重连时按 Last-Event-ID 续传；任务结束、日志读完后发 end 事件并关闭连接"""
+    if not get_run(rid):
+        return ("任务不存在", 404)
+    try:
+        last = int(request.headers.get("Last-Event-ID") or request.args.get("last") or 0)
+    except ValueError:
+        last = 0
     def gen():
-        yield "data: 连接已建立\n\n"
+        nonlocal last
+        yield ": connected\n\n"
+        idle = 0.0
         while True:
-            try:
-                msg = q.get(timeout=15)
-                yield f"data: {msg}\n\n"
-            except Empty:
-                yield "data: \n\n"
+            run = get_run(rid) or {}
+            evs = STORE.events(rid, last)   # 先读状态再读日志：结束前写入的消息一定能读到
+            if evs:
+                last = evs[-1][0]
+                yield "".join(sse_event(seq, msg) for seq, msg in evs)
+                idle = 0.0
+                continue
+            if run.get("status") in END_STATUSES:
+                yield "event: end\ndata: done\n\n"
+                return
+            if run.get("status") == "running" and time.time() - run.get("heartbeat", 0) > RUN_STALE_S:
+                yield "event: end\ndata: stalled\n\n"
+                return
+            time.sleep(STREAM_POLL_S)
+            idle += STREAM_POLL_S
+            if idle >= 15:
+                idle = 0.0
+                yield ": ping\n\n"
     headers = {
         "Content-Type":"text/event-stream",
         "Cache-Control":"no-cache",
@@ -542,30 +2529,100 @@ def stream(rid):
 
 @app.route("/download/<rid>")
 def download(rid):
-    work_dir = ensure_run(rid)["dir"]
-    xlsx = os.path.join(work_dir, f"{rid}.xlsx")
-    if not os.path.exists(xlsx):
+    """最终结果：?fmt=xlsx（默认）/ csv / jsonl"""
+    if not get_run(rid):
+        return ("任务不存在", 404)
+    fmt = request.args.get("fmt", "xlsx")
+    if fmt not in ("xlsx", "csv", "jsonl"):
+        return ("不支持的格式", 400)
+    path = os.path.join(run_dir(rid), f"{rid}.{fmt}")
+    if not os.path.exists(path):
         return ("文件尚未生成", 404)
-    return send_file(xlsx, as_attachment=True, download_name=os.path.basename(xlsx))
+    return send_file(path, as_attachment=True, download_name=os.path.basename(path))
+
+@app.route("/partial/<rid>")
+def partial(rid):
+    """运行中下载当前已出分的前 K 名（?k=，默认 PARTIAL_TOP_K；?fmt=xlsx / csv / json）"""
+    if not get_run(rid):
+        return ("任务不存在", 404)
+    k = request.args.get("k", type=int) or PARTIAL_TOP_K
+    fmt = request.args.get("fmt", "xlsx")
+    rows = partial_rows(rid)[:k]
+    name = f"{rid}_top{k}_{datetime.now().strftime('%H%M%S')}"
+    if fmt == "json":
+        return {"rid":rid, "status":get_run(rid)["status"], "rows":rows}
+    buf = io.BytesIO()
+    if fmt == "csv":
+        text = io.StringIO()
+        w = csv.writer(text)
+        w.writerow([h for h, _ in EXPORT_COLS])
+        w.writerows(export_row(r) for r in rows)
+        buf.write(text.getvalue().encode("utf-8-sig"))
+    elif fmt == "xlsx":
+        write_excel(rows, buf)
+    else:
+        return ("不支持的格式", 400)
+    buf.seek(0)
+    return send_file(buf, as_attachment=True, download_name=f"{name}.{fmt}")
 
 @app.route("/report/<rid>")
 def report(rid):
-    run = ensure_run(rid)
-    rows = run.get("summary", [])
+    run = get_run(rid)
+    if not run:
+        return ("任务不存在", 404)
+    # 运行中先展示已出分的部分
+    rows = STORE.results(rid) if run["status"] in ("done", "partial", "cancelled") else partial_rows(rid)
     return render_template_string(RANK_HTML, name=run.get("name",rid), rows=rows)
 
 @app.route("/resume/<rid>")
 def resume(rid):
-    run = ensure_run(rid)
-    if run.get("done"):
-        return redirect(url_for("events", rid=rid))
-    put(rid, "▶ 继续执行…（若已完成会直接产出）")
+    if not RID_RE.match(rid) or not load_manifest(rid):
+        return ("任务不存在或缺少输入清单，无法续跑", 404)
+    run = get_run(rid)
+    if not run:   # 状态库丢了（如换了存储后端）但磁盘上还有清单与结果日志
+        STORE.create(rid, {"name":rid, "created":time.time()})
+        run = get_run(rid)
+    if run["status"] != "done":
+        start_job(rid, resume=True)   # 执行它的进程已退出（心跳过期）时由本进程接管，按结果日志补跑缺的文件
     return redirect(url_for("events", rid=rid))
 
+@app.route("/cancel/<rid>", methods=["POST"])
+def cancel(rid):
+    """取消执行中的任务：排队中的 LLM 请求立即撤回、不再读取后续文件，已发出的请求跑完；已出的结果照常导出，可断点续跑"""
+    run = get_run(rid)
+    if not run:
+        return ("任务不存在", 404)
+    if run["status"] != "running":
+        return ("任务未在执行", 409)
+    STORE.update(rid, cancel=True)   # 由别的 worker 执行时，它的心跳线程据此取消
+    SCHED.cancel(rid)
+    put(rid, "⏹ 收到取消请求，正在撤回排队中的请求…")
+    return {"rid":rid, "cancel":True}
+
 @app.route("/healthz")
 def healthz():
     return "ok"
 
+@app.route("/metrics")
+def metrics():
+    """Prometheus 文本格式；指标按进程统计，多 worker 时每个 worker 各自累计"""
+    text = METRICS.prometheus()
+    text += f"# TYPE resume_llm_window gauge\nresume_llm_window{{tier=\"full\"}} {LIMITER.window}\n"
+    text += f"# TYPE resume_breaker_open gauge\nresume_breaker_open{{tier=\"full\"}} {int(BREAKER.state != 'closed')}\n"
+    if FAST:
+        text += f"resume_llm_window{{tier=\"fast\"}} {FAST.limiter.window}\n"
+        text += f"resume_breaker_open{{tier=\"fast\"}} {int(FAST.breaker.state != 'closed')}\n"
+    text += f"# TYPE resume_active_runs gauge\nresume_active_runs {len(SCHED.active())}\n"
+    text += f"# TYPE resume_llm_queued gauge\nresume_llm_queued{{tier=\"full\"}} {sum(LIMITER.queued().values())}\n"
+    if FAST:
+        text += f"resume_llm_queued{{tier=\"fast\"}} {sum(FAST.limiter.queued().values())}\n"
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+@app.route("/stats")
+def stats():
+    """内存/磁盘占用、清理计数与本进程各任务的 LLM 排队情况"""
+    return usage_snapshot()
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT","10000"))
     app.run(host="0.0.0.0", port=port, threaded=True)
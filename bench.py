@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""离线压测：不花 API 额度，全程本机。
+
+  python bench.py corpus  --out bench_corpus --zips 8           # 生成 Recruiter Lite 形状的 ZIP（PDF/DOCX/HTML/TXT）
+  python bench.py fake-llm --port 18080 --latency-ms 800        # 单独起一个 OpenAI 兼容的假服务
+  python bench.py run --concurrency 1,2,4,8                     # 起假服务 + 按并发档位逐个子进程跑完整 /process
+
+run 对每个并发档位单独起子进程（互不干扰、峰值内存可比），报告 文件/秒、单份 p50/p95、峰值 RSS、各格式解析耗时。
+"""
+import os, io, re, sys, json, time, random, zipfile, argparse, threading, subprocess, tempfile, resource
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Any
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# ---------- 合成简历 ----------
+FIRST = ["Wei", "Jing", "Lei", "Min", "Hao", "Yan", "Tao", "Li", "Chen", "Xin", "Alex", "Sam", "Maria", "John", "Priya", "Kenji"]
+LAST  = ["Zhang", "Wang", "Liu", "Chen", "Yang", "Zhao", "Huang", "Zhou", "Wu", "Xu", "Smith", "Garcia", "Patel", "Tanaka"]
+COMPANIES = ["Alibaba Cloud", "Tencent", "ByteDance", "Huawei", "Baidu", "Meituan", "JD.com", "NetEase", "Ant Group",
+             "Microsoft", "Amazon Web Services", "Google", "Oracle", "SAP", "Didi", "Xiaomi"]
+TITLES = ["Site Reliability Engineer", "Senior DevOps Engineer", "Platform Engineer", "Infrastructure Lead",
+          "Backend Engineer", "Engineering Manager", "Cloud Architect", "HPC Engineer", "Data Engineer"]
+SCHOOLS = ["Peking University", "Tsinghua University", "Zhejiang University", "Fudan University",
+           "Shanghai Jiao Tong University", "Nanjing University", "Wuhan University", "Sun Yat-sen University"]
+MAJORS = ["Computer Science", "Software Engineering", "Electronic Engineering", "Mathematics", "Automation"]
+SKILLS = ["Kubernetes", "DevOps", "Terraform", "Go", "Python", "Java", "Linux", "Prometheus", "HPC", "Slurm",
+          "AWS", "Docker", "Ansible", "CI/CD", "Kafka", "MySQL", "Spark", "Istio"]
+CITIES = ["Beijing", "Shanghai", "Shenzhen", "Hangzhou", "Guangzhou", "Chengdu", "Singapore"]
+FILLER = ("Led migration of legacy services to containers; reduced deployment time and improved on-call health. "
+          "Owned capacity planning, incident response and postmortems; mentored junior engineers. "
+          "Built observability stack with metrics, logs and tracing across regions. ")
+
+def persona(rng:random.Random, i:int) -> Dict[str,Any]:
+    first, last = rng.choice(FIRST), rng.choice(LAST)
+    start = rng.randint(2000, 2016)
+    jobs, y = [], start + 4
+    for _ in range(rng.randint(2, 5)):
+        span = rng.randint(1, 5)
+        jobs.append({"company":rng.choice(COMPANIES), "title":rng.choice(TITLES), "start":y, "end":min(2026, y + span),
+                     "desc":" ".join(rng.sample(SKILLS, 3)) + ". " + FILLER * rng.randint(1, 4)})
+        y += span
+    return {"name":f"{first} {last} {i}", "email":f"{first.lower()}.{last.lower()}{i}@example.com",
+            "city":rng.choice(CITIES), "skills":rng.sample(SKILLS, 5), "jobs":list(reversed(jobs)),
+            "edu":{"school":rng.choice(SCHOOLS), "major":rng.choice(MAJORS), "start":start, "end":start + 4},
+            "summary":FILLER * rng.randint(1, 3)}
+
+def profile_lines(p:Dict[str,Any]) -> List[str]:
+    """领英导出 PDF 的大致版式：联系方式 / 技能 / 简介 / 经历 / 教育，带页眉页脚噪音"""
+    out = ["Contact", p["email"], f"www.linkedin.com/in/{p['name'].lower().replace(' ', '-')}", "Top Skills"]
+    out += p["skills"][:3]
+    out += [p["name"], p["jobs"][0]["title"] + " at " + p["jobs"][0]["company"], p["city"], "Summary"]
+    out += _wrap(p["summary"])
+    out.append("Experience")
+    for j in p["jobs"]:
+        out += [j["company"], j["title"], f"{j['start']} - {j['end']}", p["city"]] + _wrap(j["desc"])
+    out += ["Education", p["edu"]["school"], f"Bachelor's degree, {p['edu']['major']} ({p['edu']['start']} - {p['edu']['end']})"]
+    return out
+
+def _wrap(text:str, width:int=90) -> List[str]:
+    lines, cur = [], ""
+    for w in text.split():
+        if len(cur) + len(w) + 1 > width:
+            lines.append(cur); cur = w
+        else:
+            cur = f"{cur} {w}".strip()
+    return lines + ([cur] if cur else [])
+
+def make_pdf(lines:List[str], per_page:int=52) -> bytes:
+    """手写最小 PDF（Helvetica，仅 ASCII），不依赖额外库；每页带“Page x of y”页脚"""
+    esc = lambda t: t.encode("latin-1", "replace").decode("latin-1").replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    pages = [lines[k:k + per_page] for k in range(0, len(lines), per_page)] or [[]]
+    objs = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for n, pg in enumerate(pages, 1):
+        body = "BT /F1 10 Tf 14 TL 50 760 Td " + " ".join(f"({esc(t)}) Tj T*" for t in pg) + \
+               f" ET BT /F1 8 Tf 280 30 Td (Page {n} of {len(pages)}) Tj ET"
+        objs.append(f"<< /Length {len(body)} >>\nstream\n{body}\nendstream")
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+                    f"/Contents {len(objs)} 0 R >>")
+        kids.append(f"{len(objs)} 0 R")
+    objs[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+    buf, offs = io.BytesIO(), []
+    buf.write(b"%PDF-1.4\n")
+    for k, o in enumerate(objs, 1):
+        offs.append(buf.tell())
+        buf.write(f"{k} 0 obj\n{o}\nendobj\n".encode("latin-1"))
+    xref = buf.tell()
+    buf.write(f"xref\n0 {len(objs)+1}\n0000000000 65535 f \n".encode())
+    buf.write("".join(f"{o:010d} 00000 n \n" for o in offs).encode())
+    buf.write(f"trailer\n<< /Size {len(objs)+1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return buf.getvalue()
+
+def make_docx(lines:List[str]) -> bytes:
+    import docx
+    d = docx.Document()
+    for t in lines:
+        d.add_paragraph(t)
+    buf = io.BytesIO()
+    d.save(buf)
+    return buf.getvalue()
+
+def make_html(lines:List[str], p:Dict[str,Any]) -> bytes:
+    nav = "".join(f"<li>{t}</li>" for t in ("Home", "My Network", "Jobs", "Messaging", "Notifications"))
+    body = "".join(f"<p>{t}</p>" for t in lines)
+    return (f"<html><head><title>{p['name']} | LinkedIn</title><style>p{{margin:0}}</style>"
+            f"<script>var x=1;</script></head><body><ul>{nav}</ul><h1>{p['name']}</h1>{body}"
+            f"<footer>© 2026 LinkedIn Corporation</footer></body></html>").encode("utf-8")
+
+def make_doc(fmt:str, p:Dict[str,Any]) -> bytes:
+    lines = profile_lines(p)
+    if fmt == "pdf":
+        return make_pdf(lines)
+    if fmt == "docx":
+        return make_docx(lines)
+    if fmt == "html":
+        return make_html(lines, p)
+    return "\n".join(lines).encode("utf-8")
+
+def gen_corpus(out:str, zips:int, per_zip:int, mix:Dict[str,float], dup_rate:float, seed:int) -> List[str]:
+    """每个 ZIP per_zip 人（Recruiter Lite 一包 25 人）；dup_rate 的人在另一个包里再出现一次（换一种格式），用于测去重"""
+    rng = random.Random(seed)
+    os.makedirs(out, exist_ok=True)
+    fmts, weights = zip(*mix.items())
+    people = [persona(rng, i) for i in range(zips * per_zip)]
+    paths = []
+    for z in range(zips):
+        path = os.path.join(out, f"recruiter_lite_export_{z+1}.zip")
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+            for p in people[z*per_zip:(z+1)*per_zip]:
+                fmt = rng.choices(fmts, weights)[0]
+                zf.writestr(f"{p['name']}.{fmt}", make_doc(fmt, p))
+            if z and dup_rate > 0:
+                for p in rng.sample(people[:z*per_zip], max(1, round(dup_rate * per_zip))):
+                    fmt = rng.choices(fmts, weights)[0]
+                    zf.writestr(f"{p['name']} (1).{fmt}", make_doc(fmt, p))
+        paths.append(path)
+    return paths
+
+# ---------- 假 LLM 服务 ----------
+class FakeLLM(BaseHTTPRequestHandler):
+    """OpenAI 兼容 /v1/chat/completions：延迟按对数正态分布（中位数 latency_ms、离散度 sigma），
+    按比例返回 5xx、429（带 Retry-After）与坏 JSON；支持批量提示（<<<候选人 ID>>>）与修复调用"""
+    cfg: Dict[str,float] = {"latency_ms":800, "sigma":0.5, "error_rate":0.0, "rate_429":0.0, "malformed_rate":0.0,
+                            "no_json_mode":0}
+    stats: Dict[str,int] = {"requests":0, "errors":0, "throttled":0, "malformed":0}
+    lock = threading.Lock()
+
+    def log_message(self, *a):
+        pass
+
+    def _send(self, code:int, obj:Any, headers:Dict[str,str]=None):
+        b = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(b)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(b)
+
+    def do_GET(self):
+        with self.lock:
+            self._send(200, dict(self.stats))
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        c, rng = self.cfg, random.Random()
+        if c["no_json_mode"] and "response_format" in body:   # 模拟不支持 JSON mode 的服务
+            return self._send(400, {"error":{"message":"response_format is not supported"}})
+        with self.lock:
+            self.stats["requests"] += 1
+        time.sleep(rng.lognormvariate(0, c["sigma"]) * c["latency_ms"] / 1000)
+        roll = rng.random()
+        if roll < c["rate_429"]:
+            with self.lock:
+                self.stats["throttled"] += 1
+            return self._send(429, {"error":{"message":"rate limited"}}, {"Retry-After":"1"})
+        if roll < c["rate_429"] + c["error_rate"]:
+            with self.lock:
+                self.stats["errors"] += 1
+            return self._send(503, {"error":{"message":"overloaded"}})
+        msgs = body.get("messages", [])
+        user = msgs[-1]["content"] if msgs else ""
+        finish = "stop"
+        if msgs and "仅返回合法 JSON" in msgs[0]["content"]:   # 修复调用：去掉坏掉的部分
+            content = json.dumps(_fake_result(user), ensure_ascii=False)
+        else:
+            ids = re.findall(r"<<<候选人 (\S+)>>>", user)
+            if ids:
+                segs = [user.split(f"<<<候选人 {cid}>>>", 1)[1] for cid in ids]
+                content = json.dumps([dict(_fake_result(sg), id=cid) for cid, sg in zip(ids, segs)], ensure_ascii=False)
+            else:
+                content = json.dumps(_fake_result(user), ensure_ascii=False)
+            if rng.random() < c["malformed_rate"]:
+                with self.lock:
+                    self.stats["malformed"] += 1
+                content, finish = _break_json(content, rng, bool(body.get("response_format")))
+        prompt = sum(len(m.get("content", "")) for m in msgs) // 3
+        self._send(200, {"choices":[{"message":{"role":"assistant", "content":content}, "finish_reason":finish}],
+                         "usage":{"prompt_tokens":prompt, "completion_tokens":len(content)//3,
+                                  "total_tokens":prompt + len(content)//3}})
+
+def _fake_result(text:str) -> Dict[str,Any]:
+    m = re.search(r"([A-Z][a-z]+ [A-Z][a-z]+ \d+)", text)
+    name = m.group(1) if m else "Unknown"
+    r = random.Random(name)
+    score = r.randint(40, 98)
+    return {"name":name, "current_company":r.choice(COMPANIES), "current_title":r.choice(TITLES),
+            "email":"", "location":r.choice(CITIES), "age_estimate":"", "tags":r.sample(SKILLS, 3),
+            "education":[{"school":r.choice(SCHOOLS), "major":r.choice(MAJORS), "degree":"本科", "start":"2008", "end":"2012"}],
+            "experiences":[], "fit_summary":"平台与稳定性经验匹配", "risks":"管理经验偏少",
+            "remark":"2008-2012年 就读于某大学；2012年至今 从事基础设施工作", "score":score,
+            "grade":"A+" if score >= 90 else "A" if score >= 80 else "B" if score >= 65 else "C"}
+
+def _break_json(content:str, rng:random.Random, json_mode:bool):
+    """模拟常见的坏输出：代码块包裹、尾逗号、被截断。JSON mode 下服务端保证格式，只剩撞上 max_tokens 的截断。
+    返回 (内容, finish_reason)"""
+    kind = "truncate" if json_mode else rng.choice(["fence", "comma", "truncate"])
+    if kind == "fence":
+        return "好的，结果如下：\n```json\n" + content + "\n```", "stop"
+    if kind == "comma":
+        return re.sub(r"\}(\s*\]?)$", r",}\1", content.rstrip()), "stop"
+    return content[:max(10, len(content) * 2 // 3)], "length"
+
+def serve_fake(port:int, cfg:Dict[str,float]) -> ThreadingHTTPServer:
+    FakeLLM.cfg.update(cfg)
+    srv = ThreadingHTTPServer(("127.0.0.1", port), FakeLLM)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+# ---------- 压测驱动 ----------
+JOB = {"role":"SRE Lead", "track":"基础设施", "must":"Kubernetes, DevOps, Linux", "nice":"HPC, Terraform",
+       "limits":"", "note":"偏好有大规模集群经验"}
+
+def bench_once(zips:List[str], timeout:float) -> Dict[str,Any]:
+    """子进程内：经 Flask test client 走完整 /process（含上传），等任务结束后读指标"""
+    import app as A
+    c = A.app.test_client()
+    data = dict(JOB, files=[(open(p, "rb"), os.path.basename(p)) for p in zips])
+    t0 = time.time()
+    r = c.post("/process", data=data, content_type="multipart/form-data")
+    rid = r.headers.get("Location", "").rstrip("/").split("/")[-1]
+    run = A.get_run(rid)
+    while run and run["status"] not in A.END_STATUSES and time.time() - t0 < timeout:
+        time.sleep(0.1)
+        run = A.get_run(rid)
+    wall = time.time() - t0
+    M = A.METRICS
+    per = M.hist("resume_seconds")
+    if A.PARSER and A.PARSER.ex:   # 回收解析子进程后 RUSAGE_CHILDREN 才有数
+        A.PARSER.ex.shutdown(wait=True)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss   # 解析子进程
+    return {"status":run["status"] if run else "missing", "files":per["count"], "wall_s":round(wall, 2),
+            "files_per_s":round(per["count"] / wall, 2) if wall else 0,
+            "p50_s":round(per["p50"], 3), "p95_s":round(per["p95"], 3),
+            "peak_rss_mb":round(rss / 1024, 1), "peak_child_rss_mb":round(kids / 1024, 1),
+            "llm_requests":M.hist("llm_latency_seconds")["count"],
+            "llm_errors":sum(v for k, v in M.by_label("llm_requests_total", "outcome").items() if k != "ok"),
+            "json":M.by_label("json_parse_total", "result"),
+            "parse":{ext: {"n":M.hist("extract_seconds", ext=ext)["count"],
+                           "sum_s":round(M.hist("extract_seconds", ext=ext)["sum"], 2),
+                           "p95_ms":round(M.hist("extract_seconds", ext=ext)["p95"] * 1000)}
+                     for ext in M.hist_labels("extract_seconds", "ext")}}
+
+def run_bench(args):
+    zips = sorted(os.path.join(args.corpus, f) for f in os.listdir(args.corpus) if f.endswith(".zip")) \
+        if os.path.isdir(args.corpus) else []
+    if not zips:
+        zips = gen_corpus(args.corpus, args.zips, args.per_zip, parse_mix(args.mix), args.dup_rate, args.seed)
+    srv = serve_fake(args.port, fake_cfg(args))
+    results = []
+    try:
+        for conc in [int(x) for x in args.concurrency.split(",")]:
+            with tempfile.TemporaryDirectory(prefix="bench_") as work:
+                env = dict(os.environ, MODEL_BASE_URL=f"http://127.0.0.1:{args.port}", MODEL_API_KEY="bench",
+                           CONCURRENCY=str(conc), MAX_CONCURRENCY=str(conc), CACHE_MAX_ENTRIES="0",
+                           BATCH_SIZE=str(args.batch_size), PARSE_PROCS=str(args.parse_procs),
+                           PARSE_WORKERS=str(args.parse_procs or 2), PYTHONPATH=ROOT)
+                p = subprocess.run([sys.executable, os.path.join(ROOT, "bench.py"), "_once", "--timeout", str(args.timeout)]
+                                   + [os.path.abspath(z) for z in zips],
+                                   cwd=work, env=env, capture_output=True, text=True, timeout=args.timeout + 60)
+                line = (p.stdout.strip().splitlines() or [""])[-1]
+                try:
+                    res = json.loads(line)
+                except ValueError:
+                    sys.stderr.write(p.stderr[-2000:])
+                    res = {"status":"crashed"}
+                res["concurrency"] = conc
+                results.append(res)
+                print_row(res)
+    finally:
+        srv.shutdown()
+    print(f"假服务统计：{json.dumps(FakeLLM.stats, ensure_ascii=False)}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+def print_row(r:Dict[str,Any]):
+    if r.get("status") == "crashed":
+        print(f"并发 {r['concurrency']:>3}：子进程失败")
+        return
+    parse = "；".join(f"{ext} {v['n']}个 {v['sum_s']}s p95 {v['p95_ms']}ms" for ext, v in r["parse"].items())
+    print(f"并发 {r['concurrency']:>3}：{r['files']} 份 / {r['wall_s']}s = {r['files_per_s']} 份/秒，"
+          f"单份 p50 {r['p50_s']}s p95 {r['p95_s']}s，峰值 RSS {r['peak_rss_mb']}MB（解析子进程 {r['peak_child_rss_mb']}MB），"
+          f"LLM {r['llm_requests']} 次 失败 {r['llm_errors']:g}，状态 {r['status']}\n        解析：{parse}\n"
+          f"        JSON：{json.dumps(r['json'], ensure_ascii=False)}")
+
+def parse_mix(s:str) -> Dict[str,float]:
+    return {k.strip(): float(v) for k, v in (kv.split("=") for kv in s.split(","))}
+
+def fake_cfg(args) -> Dict[str,float]:
+    return {"latency_ms":args.latency_ms, "sigma":args.latency_sigma, "error_rate":args.error_rate,
+            "rate_429":args.rate_429, "malformed_rate":args.malformed_rate, "no_json_mode":int(args.no_json_mode)}
+
+def main():
+    ap = argparse.ArgumentParser(description="离线压测")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    def corpus_opts(p):
+        p.add_argument("--zips", type=int, default=8)
+        p.add_argument("--per-zip", type=int, default=25)
+        p.add_argument("--mix", default="pdf=0.6,html=0.2,docx=0.1,txt=0.1")
+        p.add_argument("--dup-rate", type=float, default=0.04, help="跨包重复出现的比例")
+        p.add_argument("--seed", type=int, default=7)
+
+    def fake_opts(p):
+        p.add_argument("--port", type=int, default=18080)
+        p.add_argument("--latency-ms", type=float, default=800, help="延迟中位数")
+        p.add_argument("--latency-sigma", type=float, default=0.5, help="对数正态离散度，0 为固定延迟")
+        p.add_argument("--error-rate", type=float, default=0.0, help="5xx 比例")
+        p.add_argument("--rate-429", type=float, default=0.0)
+        p.add_argument("--malformed-rate", type=float, default=0.0, help="坏 JSON 比例（请求带 JSON mode 时只模拟截断）")
+        p.add_argument("--no-json-mode", action="store_true", help="模拟不支持 response_format 的服务（返回 400）")
+
+    p = sub.add_parser("corpus", help="生成合成简历 ZIP")
+    p.add_argument("--out", default="bench_corpus")
+    corpus_opts(p)
+    p = sub.add_parser("fake-llm", help="启动假 LLM 服务")
+    fake_opts(p)
+    p = sub.add_parser("run", help="端到端压测")
+    p.add_argument("--corpus", default="bench_corpus", help="ZIP 所在目录，不存在则先生成")
+    p.add_argument("--concurrency", default="1,2,4,8")
+    p.add_argument("--batch-size", type=int, default=1)
+    p.add_argument("--parse-procs", type=int, default=2)
+    p.add_argument("--timeout", type=float, default=900)
+    p.add_argument("--json", help="结果另存为 JSON")
+    corpus_opts(p)
+    fake_opts(p)
+    p = sub.add_parser("_once")   # 内部：单个并发档位
+    p.add_argument("--timeout", type=float, default=900)
+    p.add_argument("zips", nargs="+")
+    args = ap.parse_args()
+
+    if args.cmd == "corpus":
+        for z in gen_corpus(args.out, args.zips, args.per_zip, parse_mix(args.mix), args.dup_rate, args.seed):
+            print(z)
+    elif args.cmd == "fake-llm":
+        serve_fake(args.port, fake_cfg(args))
+        print(f"fake LLM on http://127.0.0.1:{args.port}  (MODEL_BASE_URL)")
+        while True:
+            time.sleep(3600)
+    elif args.cmd == "run":
+        run_bench(args)
+    else:
+        print(json.dumps(bench_once(args.zips, args.timeout), ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()